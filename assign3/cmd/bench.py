@@ -0,0 +1,116 @@
+import click
+import time
+
+import features.features as features
+import utils.images as images
+
+
+def matching(base_path: str, repeats: int, detector: str):
+    '''
+    Benchmark the matcher backends for 'detector' on all images found in 'base_path' and report the matches per second.
+    '''
+    img_paths, ok = images.list(base_path)
+    if not ok:
+        click.echo('No images found')
+        return
+
+    # Use a fixed image set: all images in sorted order with all combinations
+    imgs, err = images.load_images(sorted(img_paths))
+    if err != None:
+        click.echo(f'Failed to load images: {err.message}')
+        return
+
+    combis = images.get_all_combinations(imgs)
+
+    click.echo('\nExtracting keypoints of {} image(s) ({} combinations)...'.format(len(imgs), len(combis)))
+    kp_list = features.get_keypoints(imgs, combis, features.features_params(detector=detector))
+
+    backends = [
+        ('flann', False),
+        ('bf', False),
+        ('bf', True),
+    ]
+
+    sep = '-' * 68
+    click.echo(f'\n{sep}')
+    click.echo('{:<16} {:>12} {:>12} {:>12} {:>12}'.format('Backend', 'Matches', 'Filtered', 'Time [s]', 'Matches/s'))
+    click.echo(sep)
+
+    for matcher, cross_check in backends:
+        params = features.features_params(matcher=matcher, cross_check=cross_check, detector=detector)
+
+        # Run once to warm up and to count the number of (filtered) matches
+        mk_list = features.match_keypoints(kp_list, params)
+        fm_list = features.filter_matches(kp_list, mk_list)
+
+        num_matches = sum([len(mk) for mk in mk_list])
+        num_filtered = sum([len(corr) for corr in fm_list])
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            features.match_keypoints(kp_list, params)
+        elapsed = (time.perf_counter() - start) / repeats
+
+        click.echo('{:<16} {:>12} {:>12} {:>12.4f} {:>12.0f}'.format(
+            matcher + (' (cross)' if cross_check else ''),
+            num_matches,
+            num_filtered,
+            elapsed,
+            num_matches / elapsed if elapsed > 0 else 0
+        ))
+
+    click.echo(sep)
+
+
+def ransac(base_path: str, repeats: int, detector: str, threshold: float, confidence: float, max_iters: int):
+    '''
+    Benchmark the robust estimation methods of the fundamental matrix on all images found in 'base_path' and report
+    the inlier ratio and the estimated number of iterations of each combination.
+    '''
+    img_paths, ok = images.list(base_path)
+    if not ok:
+        click.echo('No images found')
+        return
+
+    imgs, err = images.load_images(sorted(img_paths))
+    if err != None:
+        click.echo(f'Failed to load images: {err.message}')
+        return
+
+    combis = images.get_all_combinations(imgs)
+
+    click.echo('\nMatching keypoints of {} image(s) ({} combinations)...'.format(len(imgs), len(combis)))
+    params = features.features_params(detector=detector)
+    kp_list = features.get_keypoints(imgs, combis, params)
+    mk_list = features.match_keypoints(kp_list, params)
+    fm_list = features.filter_matches(kp_list, mk_list)
+
+    sep = '-' * 80
+    click.echo(f'\n{sep}')
+    click.echo('{:<12} {:<10} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'Method', 'Pair', 'Matches', 'Inliers', 'Ratio', 'Iterations', 'Time [ms]'))
+    click.echo(sep)
+
+    for method in features.RANSAC_METHODS.keys():
+        r_params = features.ransac_params(method, threshold, confidence, max_iters)
+
+        for corr in fm_list:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                m = features.find_fundamental_matrices([corr], r_params)[0]
+            elapsed = (time.perf_counter() - start) / repeats
+
+            inliers = m.corr.inliers
+            ratio = inliers / len(corr) if len(corr) > 0 else 0
+
+            click.echo('{:<12} {:<10} {:>10} {:>10} {:>10.3f} {:>12} {:>10.2f}'.format(
+                method,
+                '{}-{}'.format(corr.combi[0] + 1, corr.combi[1] + 1),
+                len(corr),
+                inliers,
+                ratio,
+                features.ransac_iterations(ratio, r_params),
+                elapsed * 1000
+            ))
+
+    click.echo(sep)
@@ -0,0 +1,44 @@
+import click
+
+from thints.features import FeaturesParams
+from thints.images import SelectionParams
+
+import geometry.sweep as gsweep
+import features.features as features
+import utils.images as images
+import utils.input as inp
+import utils.ply as ply
+import exif.exif as exif
+
+
+def execute(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    output: str,
+    f_params: FeaturesParams
+):
+    imgs, _, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
+
+    ic_list = images.get_ref_combinations(imgs, ref_index)
+
+    intrinsic_matrix, err = exif.get_intrinsic_matrix(imgs[ref_index][1])
+    if err != None:
+        click.echo(f'Failed to calculate intrinsic matrix: {err.message}')
+        return
+
+    intrinsic_matrix = exif.fit_intrinsic_matrix(intrinsic_matrix, imgs[ref_index][0].shape)
+
+    click.echo('\nExtracting fundamental matrices. This takes a few seconds...')
+    fm_list, em_list = features.get_essential_matrices(imgs, ic_list, f_params, intrinsic_matrix)
+
+    cloud = gsweep.triangulate_points(em_list, fm_list, intrinsic_matrix)
+
+    if not ply.write(output, cloud):
+        click.echo(f'Failed to write point cloud to {output}')
+        return
+
+    click.echo(f'Wrote {len(cloud)} point(s) to {output}')
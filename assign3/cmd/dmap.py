@@ -1,27 +1,38 @@
-import cv2 as cv
 import click
 
+from thints.features import FeaturesParams
+from thints.images import SelectionParams
+from thints.output import OutputParams
+
 import geometry.rectification as grect
 import geometry.dmaps as gdmaps
 
 import features.features as features
-import utils.images as images
+import features.pairs as pairs
+import utils.output as output
 import utils.input as inp
 
 
 def normal(
     base_path: str,
     preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
     speckle_size: int,
     speckle_range: int,
     min_disp: int,
     num_disp: int,
     disp_diff: int,
     unique_ratio: int,
-    block_size: int
+    block_size: int,
+    threads: int,
+    max_mem: int,
+    f_params: FeaturesParams
 ):
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    combis = images.get_combinations(imgs, combi_mode, ref_index)
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
 
     # Construct stereo params
     params = gdmaps.sgbm_params(
@@ -34,39 +45,121 @@ def normal(
         block_size
     )
 
-    click.echo('\nExtracting fundamental matrices. This takes a few seconds...')
-    fm_list = features.get_fundamental_matrices(imgs, combis)
+    # Fail early if not even the thinnest strips fit into the memory budget. Portrait and landscape images can be
+    # mixed, so the largest height and the largest width bound every rectified pair
+    height = max([img[0].shape[0] for img in imgs])
+    width = max([img[0].shape[1] for img in imgs])
+    if max_mem > 0 and max_mem * gdmaps.ONE_MB_IN_BYTES < gdmaps.min_budget(width, height, params, threads):
+        click.echo('The memory budget of {} MB is too small for --num-disp {}, at least {} MB are needed'.format(
+            max_mem,
+            num_disp,
+            -(-gdmaps.min_budget(width, height, params, threads) // gdmaps.ONE_MB_IN_BYTES)
+        ))
+        return
 
-    click.echo('Rectifying...')
-    rm_list = grect.rectify(imgs, fm_list)
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
 
-    click.echo('Computing depth maps...\n')
-    dm_list = gdmaps.depth_maps(imgs, rm_list, params)
+    # Each combination streams through feature extraction, rectification and depth map computation, so the first
+    # depth map shows up as soon as it is ready
+    click.echo('\nComputing depth maps. This takes a few seconds per combination...\n')
+    fm_iter = features.iter_fundamental_matrices(imgs, combis, f_params)
+    rm_iter = grect.iter_rectify(imgs, fm_iter)
+    dm_iter = gdmaps.iter_depth_maps(imgs, rm_iter, params, threads, max_mem)
 
-    for dm in dm_list:
-        click.echo('Showing combination of image {} with image {}'.format(
-            dm[1][0] + 1,
-            dm[1][1] + 1,
-        ))
+    # Results are written in the background while the next depth map is computed
+    with output.ResultWriter(o_params) as writer:
+        for dm in dm_iter:
+            click.echo('Showing combination of image {} with image {}'.format(
+                dm.combi[0] + 1,
+                dm.combi[1] + 1,
+            ))
 
-        cv.namedWindow('disparity', cv.WINDOW_NORMAL)
-        cv.imshow('disparity', dm[0])
-        cv.waitKey(0)
+            if o_params['display']:
+                output.display('disparity', dm.disp)
+            else:
+                writer.disparity('disparity-{}-{}'.format(dm.combi[0] + 1, dm.combi[1] + 1), dm.disp, dm.raw)
 
 
 def combine(
     base_path: str,
     preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
+    speckle_size: int,
+    speckle_range: int,
+    min_disp: int,
+    num_disp: int,
+    disp_diff: int,
+    unique_ratio: int,
+    block_size: int,
+    threads: int,
+    max_mem: int,
+    f_params: FeaturesParams
+):
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
+
+    # Construct stereo params
+    params = gdmaps.sgbm_params(
+        speckle_size,
+        speckle_range,
+        min_disp,
+        num_disp,
+        disp_diff,
+        unique_ratio,
+        block_size
+    )
+
+    # Fail early if not even the thinnest strips fit into the memory budget. Portrait and landscape images can be
+    # mixed, so the largest height and the largest width bound every rectified pair
+    height = max([img[0].shape[0] for img in imgs])
+    width = max([img[0].shape[1] for img in imgs])
+    if max_mem > 0 and max_mem * gdmaps.ONE_MB_IN_BYTES < gdmaps.min_budget(width, height, params, threads):
+        click.echo('The memory budget of {} MB is too small for --num-disp {}, at least {} MB are needed'.format(
+            max_mem,
+            num_disp,
+            -(-gdmaps.min_budget(width, height, params, threads) // gdmaps.ONE_MB_IN_BYTES)
+        ))
+        return
+
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
+
+    # Depth maps are combined as they stream in, so only one depth map and the running sum are kept in memory
+    click.echo('\nComputing and combining depth maps. This takes a few seconds per combination...')
+    fm_iter = features.iter_fundamental_matrices(imgs, combis, f_params)
+    rm_iter = grect.iter_rectify(imgs, fm_iter)
+    dm = gdmaps.combine_maps(gdmaps.iter_depth_maps(imgs, rm_iter, params, threads, max_mem))
+
+    if o_params['display']:
+        output.display('disparity', dm)
+        return
+
+    with output.ResultWriter(o_params) as writer:
+        writer.disparity('disparity-combined', dm)
+
+
+def pyramid(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
     speckle_size: int,
     speckle_range: int,
     min_disp: int,
     num_disp: int,
     disp_diff: int,
     unique_ratio: int,
-    block_size: int
+    block_size: int,
+    levels: int,
+    threads: int,
+    f_params: FeaturesParams
 ):
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    combis = images.get_combinations(imgs, combi_mode, ref_index)
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
 
     # Construct stereo params
     params = gdmaps.sgbm_params(
@@ -79,18 +172,25 @@ def combine(
         block_size
     )
 
-    click.echo('\nExtracting fundamental matrices. This takes a few seconds...')
-    fm_list = features.get_fundamental_matrices(imgs, combis)
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
 
-    click.echo('Rectifying...')
-    rm_list = grect.rectify(imgs, fm_list)
+    click.echo('\nComputing depth maps coarse-to-fine. This takes a few seconds per combination...\n')
+    fm_iter = features.iter_fundamental_matrices(imgs, combis, f_params)
+    rm_iter = grect.iter_rectify(imgs, fm_iter)
+    dm_iter = gdmaps.iter_pyramid_depth_maps(imgs, rm_iter, params, levels, threads)
 
-    click.echo('Computing depth maps...')
-    dm_list = gdmaps.depth_maps(imgs, rm_list, params)
+    with output.ResultWriter(o_params) as writer:
+        for dm, times in dm_iter:
+            click.echo('Showing combination of image {} with image {}'.format(
+                dm.combi[0] + 1,
+                dm.combi[1] + 1,
+            ))
 
-    click.echo('Combining depth maps...')
-    dm = gdmaps.combine_maps(dm_list)
+            # Report the time spent on each level, coarsest first
+            for i, t in enumerate(times):
+                click.echo('  Level {} (1/{} scale): {:.2f}s'.format(len(times) - 1 - i, 2 ** (len(times) - 1 - i), t))
 
-    cv.namedWindow('disparity', cv.WINDOW_NORMAL)
-    cv.imshow('disparity', dm)
-    cv.waitKey(0)
+            if o_params['display']:
+                output.display('disparity', dm.disp)
+            else:
+                writer.disparity('disparity-pyramid-{}-{}'.format(dm.combi[0] + 1, dm.combi[1] + 1), dm.disp, dm.raw)
@@ -2,61 +2,94 @@ import numpy as np
 import cv2 as cv
 import click
 
+from thints.features import FeaturesParams
+from thints.images import SelectionParams
+from thints.output import OutputParams
+
 import features.features as features
+import features.pairs as pairs
 import utils.drawing as drawing
-import utils.images as images
+import utils.output as output
 import utils.input as inp
 
 
-def epilines(base_path: str, preview: bool):
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    combis = images.get_combinations(imgs, combi_mode, ref_index)
+def epilines(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
+    f_params: FeaturesParams
+):
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
+
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
 
     # Get epilines, one function call is just all it takes
     click.echo('\nExtracting epilines. This takes a few seconds...\n')
-    epilines_list = features.get_epilines(imgs, combis)
+    epilines_list = features.get_epilines(imgs, combis, f_params)
+
+    with output.ResultWriter(o_params) as writer:
+        for c in epilines_list:
+            click.echo('Showing combination of image {} with image {} with a total of {} lines'.format(
+                c.combi[0] + 1,
+                c.combi[1] + 1,
+                len(c.left)
+            ))
 
-    for c in epilines_list:
-        click.echo('Showing combination of image {} with image {} with a total of {} lines'.format(
-            c[1][0] + 1,
-            c[1][1] + 1,
-            len(c[0][0])
-        ))
+            img_left = drawing.epilines(
+                imgs[c.combi[0]][0],
+                c.right
+            )
+            img_right = drawing.epilines(
+                imgs[c.combi[1]][0],
+                c.left
+            )
 
-        img_left = drawing.epilines(
-            imgs[c[1][0]][0],
-            c[0][1]
-        )
-        img_right = drawing.epilines(
-            imgs[c[1][1]][0],
-            c[0][0]
-        )
+            frame = np.concatenate((img_left, img_right), axis=1)
+            if o_params['display']:
+                output.display('epilines', frame)
+            else:
+                writer.image('epilines-{}-{}'.format(c.combi[0] + 1, c.combi[1] + 1), frame)
 
-        cv.namedWindow('epilines', cv.WINDOW_NORMAL)
-        cv.imshow('epilines', np.concatenate((img_left, img_right), axis=1))
-        cv.waitKey(0)
+    if o_params['display']:
+        cv.destroyAllWindows()
 
-    cv.destroyAllWindows()
 
+def points(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
+    f_params: FeaturesParams
+):
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
 
-def points(base_path: str, preview: bool):
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    combis = images.get_combinations(imgs, combi_mode, ref_index)
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
 
     # Get matching points
     click.echo('\nExtracting matching points. This takes a few seconds...\n')
-    points_list = features.get_points(imgs, combis)
+    points_list = features.get_points(imgs, combis, f_params)
 
-    for p in points_list:
-        click.echo('Showing combination of image {} with image {} with a total of {} points'.format(
-            p[4][0] + 1,
-            p[4][1] + 1,
-            len(p[0])
-        ))
+    with output.ResultWriter(o_params) as writer:
+        for p in points_list:
+            click.echo('Showing combination of image {} with image {} with a total of {} points'.format(
+                p.combi[0] + 1,
+                p.combi[1] + 1,
+                len(p.left)
+            ))
 
-        frame = drawing.matching_keypoints(imgs[p[4][0]][0], p[0], imgs[p[4][1]][0], p[1], p[2], p[3])
-        cv.namedWindow('matches', cv.WINDOW_NORMAL)
-        cv.imshow('matches', frame)
-        cv.waitKey(0)
+            frame = drawing.matching_keypoints(
+                imgs[p.combi[0]][0], p.left, imgs[p.combi[1]][0], p.right, p.matches, p.mask)
+            if o_params['display']:
+                output.display('matches', frame)
+            else:
+                writer.image('matches-{}-{}'.format(p.combi[0] + 1, p.combi[1] + 1), frame)
 
-    cv.destroyAllWindows()
+    if o_params['display']:
+        cv.destroyAllWindows()
@@ -1,28 +1,41 @@
 import numpy as np
-import cv2 as cv
 import click
 
+from thints.features import FeaturesParams
+from thints.images import SelectionParams
+from thints.output import OutputParams
+
 import geometry.rectification as grect
 import features.features as features
-import utils.images as images
+import features.pairs as pairs
+import utils.output as output
 import utils.input as inp
 
 
-def execute(base_path: str, preview: bool, thresh: int):
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    combis = images.get_combinations(imgs, combi_mode, ref_index)
-
-    click.echo('\nExtracting fundamental matrices. This takes a few seconds...')
-    fm_list = features.get_fundamental_matrices(imgs, combis)
-
-    click.echo('Rectifying...')
-    rm_list = grect.rectify(imgs, fm_list, thresh)
-
-    cv.namedWindow('rectify', cv.WINDOW_NORMAL)
-
-    for rm in rm_list:
-        img_l = cv.warpPerspective(imgs[rm[4][0]][0], rm[0], rm[2])
-        img_r = cv.warpPerspective(imgs[rm[4][1]][0], rm[1], rm[3])
-
-        cv.imshow('rectify', np.concatenate((img_l, img_r), axis=1))
-        cv.waitKey(0)
+def execute(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
+    thresh: int,
+    f_params: FeaturesParams
+):
+    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
+
+    combis = pairs.get_combinations(imgs, combi_mode, ref_index, f_params)
+
+    click.echo('\nRectifying. This takes a few seconds per combination...')
+    fm_iter = features.iter_fundamental_matrices(imgs, combis, f_params)
+    rm_iter = grect.iter_rectify(imgs, fm_iter, thresh)
+
+    with output.ResultWriter(o_params) as writer:
+        for rm in rm_iter:
+            img_l, img_r = grect.rectify_images(imgs, rm)
+
+            if o_params['display']:
+                output.display('rectify', np.concatenate((img_l, img_r), axis=1))
+            else:
+                writer.pair('rectified-{}-{}'.format(rm.combi[0] + 1, rm.combi[1] + 1), img_l, img_r)
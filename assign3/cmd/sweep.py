@@ -1,21 +1,64 @@
+import cv2 as cv
 import click
 
+from thints.geometry import SweepNeighbour
+from thints.features import FeaturesParams
+from thints.images import SelectionParams
+from thints.output import OutputParams
+import geometry.sweep as gsweep
 import features.features as features
 import utils.images as images
+import utils.profile as profile
+import utils.output as output
 import utils.input as inp
 import exif.exif as exif
 
 
-def execute(base_path: str, preview: bool):
-    ''''''
-    imgs, combi_mode, ref_index = inp.handle_images(base_path, preview)
-    ic_list = images.get_combinations(imgs, combi_mode, ref_index)
+def execute(
+    base_path: str,
+    preview: bool,
+    scale: int,
+    selection: SelectionParams,
+    o_params: OutputParams,
+    min_depth: float,
+    max_depth: float,
+    layers: int,
+    window: int,
+    max_mem: int,
+    streaming: bool,
+    subpixel: bool,
+    uniqueness: int,
+    f_params: FeaturesParams
+):
+    imgs, _, ref_index = inp.handle_images(base_path, preview, scale, selection)
+    if imgs is None:
+        return
+
+    ic_list = images.get_ref_combinations(imgs, ref_index)
+    ref = imgs[ref_index][0]
 
-    intrinsic_matrix, err = exif.get_intrinsic_matrix(imgs[0][1])
+    intrinsic_matrix, err = exif.get_intrinsic_matrix(imgs[ref_index][1])
     if err != None:
         click.echo(f'Failed to calculate intrinsic matrix: {err.message}')
         return
 
+    intrinsic_matrix = exif.fit_intrinsic_matrix(intrinsic_matrix, ref.shape)
+
+    # Construct plane sweep params
+    params = gsweep.sweep_params(min_depth, max_depth, layers, window, max_mem, streaming, subpixel, uniqueness)
+
     click.echo('\nExtracting fundamental matrices. This takes a few seconds...')
-    fm_list = features.get_fundamental_matrices(imgs, ic_list)
-    em_list = features.find_essential_matrices(fm_list, intrinsic_matrix)
+    fm_list, em_list = features.get_essential_matrices(imgs, ic_list, f_params, intrinsic_matrix)
+    poses = gsweep.relative_poses(em_list, fm_list, intrinsic_matrix)
+
+    click.echo('Sweeping planes. This takes a few seconds...')
+    neighbours = [SweepNeighbour(imgs[p.combi[1]][0], p.r, p.t) for p in poses]
+    with profile.stage('plane_sweep'):
+        depth = gsweep.plane_sweep(ref, neighbours, intrinsic_matrix, params)
+
+    if o_params['display']:
+        output.display('depth', cv.normalize(depth, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U))
+        return
+
+    with output.ResultWriter(o_params) as writer:
+        writer.disparity('depth-{}'.format(ref_index + 1), depth)
@@ -129,3 +129,36 @@ def get_intrinsic_matrix(path: str) -> Tuple[np.ndarray, ExifError]:
     m[2, 2] = 1  # Does this need to be 1 or 0?
 
     return m, None
+
+
+def fit_intrinsic_matrix(m: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    '''
+    Fit the intrinsic camera matrix 'm' to an image with 'shape'. OpenCV applies the EXIF orientation when loading
+    images, so the loaded image can be rotated relative to the EXIF image dimensions. In this case the axes of the
+    matrix get swapped. Afterwards the matrix is scaled to the image size (e.g. for downscaled images).
+
+    Parameters
+    ----------
+    m : np.ndarray
+        Intrinsic camera matrix
+    shape : Tuple[int, int]
+        Shape (height, width) of the loaded image
+
+    Returns
+    -------
+    m : np.ndarray
+        The fitted intrinsic camera matrix
+    '''
+    m = m.copy()
+    height, width = shape[:2]
+
+    # The principal point sits in the image center, so its position tells the EXIF orientation
+    if (m[0, 2] > m[1, 2]) != (width > height):
+        m[[0, 1]] = m[[1, 0]]
+        m[:, [0, 1]] = m[:, [1, 0]]
+
+    m[0] *= width / (2.0 * m[0, 2])
+    m[1] *= height / (2.0 * m[1, 2])
+    m[2] = (0, 0, 1)
+
+    return m
@@ -0,0 +1,78 @@
+from typing import Callable, Dict, Tuple
+import numpy as np
+import cv2 as cv
+
+import features.store as store
+
+# Maximum number of features retained per image
+MAX_FEATURES = 500
+
+# Registry of available detectors. Each entry creates a new detector object
+DETECTORS: Dict[str, Callable[[], cv.Feature2D]] = {
+    'sift': lambda: cv.SIFT_create(nfeatures=MAX_FEATURES),
+    'orb': lambda: cv.ORB_create(nfeatures=MAX_FEATURES),
+    'akaze': lambda: cv.AKAZE_create(),
+    'brisk': lambda: cv.BRISK_create(),
+}
+
+# Detectors which compute binary descriptors. These descriptors are matched via the Hamming distance
+BINARY_DETECTORS = ['orb', 'akaze', 'brisk']
+
+
+def create(name: str) -> cv.Feature2D:
+    '''
+    Create a new detector object with 'name' from the registry.
+    '''
+    return DETECTORS[name]()
+
+
+def is_binary(name: str) -> bool:
+    '''
+    Return if the detector with 'name' computes binary descriptors.
+    '''
+    return name in BINARY_DETECTORS
+
+
+def key(name: str, scale: int = 1) -> str:
+    '''
+    Return the detector name including its parameters, e.g. 'sift-500'. This is used as part of the feature store key.
+    Features of downscaled images are stored separately, e.g. 'sift-500-s4'.
+    '''
+    if scale == 1:
+        return '{}-{}'.format(name, MAX_FEATURES)
+
+    return '{}-{}-s{}'.format(name, MAX_FEATURES, scale)
+
+
+def detect(name: str, img: cv.Mat) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Detect keypoints and compute descriptors of a single image with the detector 'name'. Detectors which don't limit
+    the number of features themselves keep the MAX_FEATURES keypoints with the strongest response. This function is
+    executed in worker processes and therefore returns plain NumPy arrays instead of lists of cv.KeyPoint.
+
+    Parameters
+    ----------
+    name : str
+        Name of the detector
+    img : cv.Mat
+        Image (matrix)
+
+    Returns
+    -------
+    result : Tuple[np.ndarray, np.ndarray]
+        Nx6 keypoint attribute array (x, y, size, angle, response, octave) and the descriptor matrix
+    '''
+    detector = create(name)
+
+    if name in ['sift', 'orb']:
+        kpoints, des = detector.detectAndCompute(img, None)
+    else:
+        kpoints = detector.detect(img, None)
+        kpoints = sorted(kpoints, key=lambda kp: kp.response, reverse=True)[:MAX_FEATURES]
+        kpoints, des = detector.compute(img, kpoints)
+
+    if des is None:
+        dtype = np.uint8 if is_binary(name) else np.float32
+        des = np.empty((0, detector.descriptorSize()), dtype)
+
+    return store.keypoints_to_array(kpoints), des
@@ -1,11 +1,28 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple
 import numpy as np
 import cv2 as cv
 
 from thints.images import ImageList, CombinationsList
+import features.detectors as detectors
+import features.store as store
+import features.posegraph as posegraph
+import utils.profile as profile
 from thints.features import (
     FundamentalMatricesList,
+    KeypointDescriptorCache,
+    FundamentalMatrix,
+    Correspondences,
+    FeaturesParams,
+    RansacParams,
     KeypointDescriptorList,
     EssentialMatricesList,
+    EssentialMatrix,
+    PairKeypoints,
+    Keypoints,
+    Matches,
+    Epilines,
+    Points,
     FilteredMatchesList,
     FlannMatchesList,
     EpilinesList,
@@ -13,92 +30,316 @@ from thints.features import (
 )
 
 
+# Robust estimation methods of the fundamental matrix
+RANSAC_METHODS = {
+    'ransac': cv.FM_RANSAC,
+    'magsac': cv.USAC_MAGSAC,
+    'usac-fast': cv.USAC_FAST,
+    'prosac': cv.USAC_PROSAC,
+}
+
+# Number of point pairs of a minimal sample for the fundamental matrix
+RANSAC_SAMPLE_SIZE = 7
+
+
 class FeaturesError:
     def __init__(self, message: str) -> None:
         self.message = message
 
 
-def get_keypoints(imgs: ImageList, combis: CombinationsList) -> KeypointDescriptorList:
+def features_params(
+    workers: int = 1,
+    use_store: bool = True,
+    matcher: str = 'flann',
+    cross_check: bool = False,
+    detector: str = 'sift',
+    top_k: int = 2,
+    ranking: str = 'bovw',
+    ransac: RansacParams = None,
+    scale: int = 1
+) -> FeaturesParams:
+    '''
+    Construct a new FeaturesParams typed dict.
+    '''
+    if ransac is None:
+        ransac = ransac_params()
+
+    p: FeaturesParams = {
+        'cross_check': cross_check,
+        'use_store': use_store,
+        'detector': detector,
+        'workers': workers,
+        'matcher': matcher,
+        'top_k': top_k,
+        'ranking': ranking,
+        'ransac': ransac,
+        'scale': scale
+    }
+    return p
+
+
+def ransac_params(
+    method: str = 'ransac',
+    threshold: float = 3.0,
+    confidence: float = 0.99,
+    max_iters: int = 1000
+) -> RansacParams:
+    '''
+    Construct a new RansacParams typed dict. The defaults match the defaults of cv.findFundamentalMat.
+    '''
+    p: RansacParams = {
+        'confidence': confidence,
+        'threshold': threshold,
+        'max_iters': max_iters,
+        'method': method
+    }
+    return p
+
+
+def init_worker():
+    '''
+    Initialize a feature extraction worker process. OpenCV's internal threading is disabled, as the parallelism already
+    comes from the worker processes.
+    '''
+    cv.setNumThreads(1)
+
+
+def detect_all(imgs: ImageList, indices: List[int], params: FeaturesParams) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
     '''
-    Return a list of keypoints and descriptors for each combination.
+    Detect keypoints and compute descriptors of all images at 'indices' with the selected detector. Features are read
+    from the on-disk feature store if possible. The remaining images are processed in a pool of 'workers' processes.
 
     Parameters
     ----------
     imgs : ImageList
         List of images
+    indices : List[int]
+        Indices of the images to process
+    params : FeaturesParams
+        Feature extraction params
+
+    Returns
+    -------
+    features : Dict[int, Tuple[np.ndarray, np.ndarray]]
+        Keypoint attribute array and descriptor matrix for each image index
+    '''
+    detector = detectors.key(params['detector'], params['scale'])
+    kd_arrays: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    # Read all available features from the store first
+    missing: List[int] = []
+    for index in indices:
+        if params['use_store']:
+            kd, ok = store.load(imgs[index][1], detector)
+            if ok:
+                kd_arrays[index] = kd
+                continue
+
+        missing.append(index)
+
+    # Compute the missing features, either in this process or in a pool of worker processes
+    if params['workers'] > 1 and len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=min(params['workers'], len(missing)), initializer=init_worker) as pool:
+            results = list(pool.map(
+                detectors.detect,
+                [params['detector']] * len(missing),
+                [imgs[index][0] for index in missing]
+            ))
+    else:
+        results = [detectors.detect(params['detector'], imgs[index][0]) for index in missing]
+
+    for index, kd in zip(missing, results):
+        kd_arrays[index] = kd
+
+        if params['use_store']:
+            store.save(imgs[index][1], detector, kd[0], kd[1])
+
+    return kd_arrays
+
+
+def get_keypoints(
+    imgs: ImageList,
+    combis: CombinationsList,
+    params: FeaturesParams,
+    kd_cache: KeypointDescriptorCache = None
+) -> KeypointDescriptorList:
+    '''
+    Return a list of keypoints and descriptors for each combination. Keypoints and descriptors are computed only once
+    per image and are shared between all combinations which include this image.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images
+    combis : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
+    kd_cache : KeypointDescriptorCache
+        Keypoints and descriptors per image index, which are reused and extended across calls (Default: None)
 
     Returns
     -------
     list : KeypointDescriptorList
         A list of keypoints and descriptors for each combination
     '''
-    # Create SIFT object
-    sift = cv.SIFT_create(nfeatures=500)
+    # Collect the indices of all images used in any of the combinations which are not cached yet
+    if kd_cache is None:
+        kd_cache = {}
+
+    indices: List[int] = []
+    for c in combis:
+        for index in c:
+            if index not in indices and index not in kd_cache:
+                indices.append(index)
+
+    # Compute keypoints and descriptors once per image. The keypoint arrays are split into views, no copies
+    with profile.stage('get_keypoints'):
+        for index, (kp_arr, des) in detect_all(imgs, indices, params).items():
+            kd_cache[index] = Keypoints(kp_arr[:, :2], kp_arr[:, 2:], des if len(des) > 0 else None)
 
     # Iterate over all combinations
     keypoints_descriptor_list: KeypointDescriptorList = []
     for c in combis:
-        # [ Tuple [ List [ List[kpoints_in_i], List[kpoints_in_j] ], List [des_in_i, des_in_j] ] ]
-        kpoints_in_i, des_in_i = sift.detectAndCompute(imgs[c[0]][0], None)
-        kpoints_in_j, des_in_j = sift.detectAndCompute(imgs[c[1]][0], None)
-
-        keypoints_descriptor_list.append(
-            (
-                [list(kpoints_in_i), list(kpoints_in_j)],
-                [des_in_i, des_in_j],
-                (c[0], c[1])
-            )
-        )
+        keypoints_descriptor_list.append(PairKeypoints(kd_cache[c[0]], kd_cache[c[1]], (c[0], c[1])))
+        profile.pair(c, keypoints_l=len(kd_cache[c[0]]), keypoints_r=len(kd_cache[c[1]]))
 
     return keypoints_descriptor_list
 
 
-def match_keypoints(kd_list: KeypointDescriptorList, trees: int = 5, checks: int = 5, k: int = 2) -> FlannMatchesList:
+def create_matcher(matcher: str, binary: bool, trees: int = 5, checks: int = 5) -> cv.DescriptorMatcher:
     '''
-    Match two sets of keypoints to each other via KNN.
+    Create a descriptor matcher for the 'matcher' backend. Binary descriptors are matched via a LSH index (flann) or
+    the Hamming distance (brute-force).
+
+    Parameters
+    ----------
+    matcher : str
+        Matcher backend. Either 'flann' (approximate KD-tree / LSH) or 'bf' (exact brute-force)
+    binary : bool
+        If the descriptors are binary
+    trees : int
+        Number of trees the Flann bases matcher uses (default 5)
+    checks : int
+        Number of checks the Flann based matcher uses (default 5)
+
+    Returns
+    -------
+    matcher : cv.DescriptorMatcher
+        The (untrained) descriptor matcher
+    '''
+    if matcher == 'bf':
+        return cv.BFMatcher(cv.NORM_HAMMING if binary else cv.NORM_L2)
+
+    # Setup flann matcher params
+    FLANN_INDEX_KDTREE = 1
+    FLANN_INDEX_LSH = 6
+
+    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=trees)
+    if binary:
+        index_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+
+    search_params = dict(checks=checks)
+
+    return cv.FlannBasedMatcher(index_params, search_params)
+
+
+def match_keypoints(
+    kd_list: KeypointDescriptorList,
+    params: FeaturesParams,
+    trees: int = 5,
+    checks: int = 5,
+    k: int = 2,
+    matchers: Dict[int, cv.DescriptorMatcher] = None
+) -> FlannMatchesList:
+    '''
+    Match two sets of keypoints to each other via KNN. One matcher is trained per image and reused by every
+    combination which uses this image, so each index is only built once. If cross checking is enabled, only matches
+    whose best match in the reverse direction points back to the same keypoint are kept.
 
     Parameters
     ----------
     kd_list : KeypointDescriptorList
         A list of keypoints and descriptors for each combination
+    params : FeaturesParams
+        Feature extraction params, which select the matcher backend and cross checking
     trees : int
         Number of trees the Flann bases matcher uses (default 5)
     checks : int
         Number of checks the matcher uses (default 5)
     k : int
-        Whatever this is? (default 2)
+        Number of nearest neighbours returned per keypoint (default 2)
+    matchers : Dict[int, cv.DescriptorMatcher]
+        Trained matchers per image index, which are reused and extended across calls (Default: None)
 
+    Returns
+    -------
     matches : FlannMatchesList
         List of matched keypoints for each combination
     '''
     # TODO (Techassi): Ask about the number of matches. Should they really be that HIGH? /shrug
-    # Setup flann matcher params
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=trees)
-    search_params = dict(checks=checks)
+    # Trained matchers, one per image index
+    if matchers is None:
+        matchers = {}
 
-    # Create flann matcher
-    flann_Matcher = cv.FlannBasedMatcher(index_params, search_params)
+    def trained_matcher(index: int, des: np.ndarray) -> cv.DescriptorMatcher:
+        # Build and train the index for each image only once
+        if index not in matchers:
+            matcher = create_matcher(params['matcher'], detectors.is_binary(params['detector']), trees, checks)
+            matcher.add([des])
+            matcher.train()
+
+            matchers[index] = matcher
+
+        return matchers[index]
 
     # Iterate ober all combinations and calculate matches
     matches: FlannMatchesList = []
     for combi in kd_list:
-        kp_matches = flann_Matcher.knnMatch(combi[1][0], combi[1][1], k=k)
-        matches.append((kp_matches, combi[2]))
+        with profile.stage('match_keypoints', combi.combi):
+            kp_matches = trained_matcher(combi.combi[1], combi.right.des).knnMatch(combi.left.des, k=k)
+
+            # The LSH index can return less than k neighbours for some keypoints, which are dropped
+            kp_matches = [km for km in kp_matches if len(km) == k]
+
+            # Move the DMatch objects into compact arrays right away
+            idx = np.array([(km[0].queryIdx, km[0].trainIdx) for km in kp_matches], np.int32).reshape(-1, 2)
+            distances = np.array([[m.distance for m in km] for km in kp_matches], np.float32).reshape(-1, k)
+
+            if params['cross_check']:
+                # Best match of each keypoint in the right image among the keypoints in the left image
+                reverse = trained_matcher(combi.combi[0], combi.left.des).match(combi.right.des)
+                reverse_idx = np.full(len(combi.right), -1, np.int32)
+                for m in reverse:
+                    reverse_idx[m.queryIdx] = m.trainIdx
+
+                keep = reverse_idx[idx[:, 1]] == idx[:, 0]
+                idx, distances = idx[keep], distances[keep]
+
+        profile.pair(combi.combi, raw_matches=len(idx))
+        matches.append(Matches(idx, distances, combi.combi))
 
     return matches
 
 
-def filter_matches(kd_list: KeypointDescriptorList, fm_list: FlannMatchesList) -> FilteredMatchesList:
+def filter_matches(
+    kd_list: KeypointDescriptorList,
+    fm_list: FlannMatchesList,
+    ratio: float = 0.8
+) -> FilteredMatchesList:
     '''
-    Filter matches based on distance to each other.
+    Filter matches based on distance to each other (ratio test). The test is applied to all matches of a combination
+    at once via NumPy arrays instead of looping over each pair of matches. The points of the good matches are sorted
+    by their ratio (best first), as PROSAC samples the points in this order.
 
     Parameters
     ----------
     kd_list : KeypointDescriptorList
         A list of keypoints and descriptors for each combination
-    fm_list : 
+    fm_list : FlannMatchesList
         A list of matched keypoints for each combination
+    ratio : float
+        Maximum ratio between the distance of the best and the second best match (Default: 0.8)
 
     Returns
     -------
@@ -107,31 +348,26 @@ def filter_matches(kd_list: KeypointDescriptorList, fm_list: FlannMatchesList) -
     '''
     filtered_matches: FilteredMatchesList = []
 
-    for i, kd in enumerate(kd_list):
-        matchesMask = [[0, 0] for k in range(len(fm_list[i][0]))]
-        points_in_right = []
-        points_in_left = []
+    for kd, mk in zip(kd_list, fm_list):
+        with profile.stage('filter_matches', mk.combi):
+            good = mk.distances[:, 0] < ratio * mk.distances[:, 1]
 
-        for j, (m, n) in enumerate(fm_list[i][0]):
-            if m.distance < 0.8*n.distance:
-                matchesMask[j] = [1, 0]
+            # Sort by ratio, the mask keeps the original order of the matches
+            order = np.argsort(mk.distances[good, 0] / np.maximum(mk.distances[good, 1], 1e-12), kind='stable')
+            idx = mk.idx[good][order]
 
-                points_in_right.append(kd[0][1][m.trainIdx].pt)
-                points_in_left.append(kd[0][0][m.queryIdx].pt)
-
-        filtered_matches.append(
-            (
-                np.int32(points_in_left),
-                np.int32(points_in_right),
-                matchesMask,
-                fm_list[i][1]
-            )
-        )
+        profile.pair(mk.combi, good_matches=len(idx))
+        filtered_matches.append(Correspondences(
+            kd.left.pts[idx[:, 0]],
+            kd.right.pts[idx[:, 1]],
+            mk.combi,
+            matches_mask=good
+        ))
 
     return filtered_matches
 
 
-def find_fundamental_matrices(fm_list: FilteredMatchesList) -> FundamentalMatricesList:
+def find_fundamental_matrices(fm_list: FilteredMatchesList, params: RansacParams = None) -> FundamentalMatricesList:
     '''
     Find fundamental matrix for each combination.
 
@@ -139,24 +375,68 @@ def find_fundamental_matrices(fm_list: FilteredMatchesList) -> FundamentalMatric
     ----------
     fm_list : FilteredMatchesList
         A list of filtered matches for each combination
+    params : RansacParams
+        Robust estimation params (Default: ransac_params())
 
     Returns
     -------
     list : FundamentalMatricesList
-        A list of the fundamental matrix, the mask, and inlier points (left and right) for each combination
+        A list of the fundamental matrix and the correspondences with the inliers moved to the front for each
+        combination
     '''
+    if params is None:
+        params = ransac_params()
+
     m_list: FundamentalMatricesList = []
 
-    for m in fm_list:
-        f, mask = cv.findFundamentalMat(m[0], m[1], cv.FM_RANSAC)
-        points_in_right = m[1][mask.ravel() == 1]
-        points_in_left = m[0][mask.ravel() == 1]
+    for corr in fm_list:
+        with profile.stage('find_fundamental_matrices', corr.combi):
+            f, mask = cv.findFundamentalMat(
+                corr.pts_l,
+                corr.pts_r,
+                RANSAC_METHODS[params['method']],
+                params['threshold'],
+                params['confidence'],
+                params['max_iters']
+            )
 
-        m_list.append((f, mask, points_in_left, points_in_right, m[3]))
+            fm = FundamentalMatrix(f, corr.partition(mask))
+
+        profile.pair(corr.combi, inliers=fm.corr.inliers)
+        m_list.append(fm)
 
     return m_list
 
 
+def ransac_iterations(inlier_ratio: float, params: RansacParams) -> int:
+    '''
+    Return the number of iterations an adaptive RANSAC needs to draw at least one outlier-free sample with the
+    requested confidence at 'inlier_ratio'. The count is capped at the maximum number of iterations. OpenCV doesn't
+    report the iterations it ran, so this is the estimate its early termination is based on.
+
+    Parameters
+    ----------
+    inlier_ratio : float
+        Ratio of inliers to all points
+    params : RansacParams
+        Robust estimation params
+
+    Returns
+    -------
+    iterations : int
+        Estimated number of iterations
+    '''
+    if inlier_ratio <= 0:
+        return params['max_iters']
+
+    p_good = inlier_ratio ** RANSAC_SAMPLE_SIZE
+    if p_good >= 1:
+        return 1
+
+    iterations = np.log(1 - params['confidence']) / np.log(1 - p_good)
+    return int(min(np.ceil(iterations), params['max_iters']))
+
+
 def find_essential_matrices(fm_list: FundamentalMatricesList, intrinsic_matrix: np.ndarray) -> EssentialMatricesList:
     '''
     Find and decompose essential matrix. The matrix gets decomposed into two possible rotation matrices and one
@@ -177,28 +457,22 @@ def find_essential_matrices(fm_list: FundamentalMatricesList, intrinsic_matrix:
     em_list: EssentialMatricesList = []
 
     for m in fm_list:
-        em, _ = cv.findEssentialMat(m[2], m[3], intrinsic_matrix)
+        em, _ = cv.findEssentialMat(m.corr.inliers_l, m.corr.inliers_r, intrinsic_matrix)
         r1, r2, t = cv.decomposeEssentialMat(em)
 
-        em_list.append((
-            em,
-            r1,
-            r2,
-            t,
-            m[4]
-        ))
+        em_list.append(EssentialMatrix(em, r1, r2, t, m.combi))
 
     return em_list
 
 
-def compute_epilines(fm_list: FundamentalMatricesList) -> EpilinesList:
+def compute_epilines(fm_list: Iterable[FundamentalMatrix]) -> EpilinesList:
     '''
     Compute the epilines for the left and right image of all combinations.
 
     Parameters
     ----------
-    fm_list : FundamentalMatricesList
-        A list of the fundamental matrix, the mask, and inlier points (left and right)
+    fm_list : Iterable[FundamentalMatrix]
+        A list of fundamental matrices
 
     Returns
     -------
@@ -207,23 +481,18 @@ def compute_epilines(fm_list: FundamentalMatricesList) -> EpilinesList:
     '''
     epilines_list: EpilinesList = []
     for item in fm_list:
-        right_lines = cv.computeCorrespondEpilines(item[3].reshape(-1, 1, 2), 2, item[0])
+        right_lines = cv.computeCorrespondEpilines(item.corr.inliers_r, 2, item.f)
         right_lines = right_lines.reshape(-1, 3)
 
-        left_lines = cv.computeCorrespondEpilines(item[2].reshape(-1, 1, 2), 1, item[0])
+        left_lines = cv.computeCorrespondEpilines(item.corr.inliers_l, 1, item.f)
         left_lines = left_lines.reshape(-1, 3)
 
-        epilines_list.append(
-            (
-                (left_lines, right_lines),
-                item[4]
-            )
-        )
+        epilines_list.append(Epilines(left_lines, right_lines, item.combi))
 
     return epilines_list
 
 
-def get_epilines(imgs: ImageList, ic_list: CombinationsList) -> EpilinesList:
+def get_epilines(imgs: ImageList, ic_list: CombinationsList, params: FeaturesParams) -> EpilinesList:
     '''
     Calculate epilines from a set of images.
 
@@ -231,20 +500,20 @@ def get_epilines(imgs: ImageList, ic_list: CombinationsList) -> EpilinesList:
     ----------
     imgs : ImageList
         List of image matrices
+    ic_list : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
 
     Returns
     -------
     epilines : EpilinesList
          A list of epilines for each combination of images
     '''
-    kp_list = get_keypoints(imgs, ic_list)
-    mk_list = match_keypoints(kp_list)
-    fm_list = filter_matches(kp_list, mk_list)
-    fm_list = find_fundamental_matrices(fm_list)
-    return compute_epilines(fm_list)
+    return compute_epilines(iter_fundamental_matrices(imgs, ic_list, params))
 
 
-def get_points(imgs: ImageList, ic_list: CombinationsList) -> PointsList:
+def get_points(imgs: ImageList, ic_list: CombinationsList, params: FeaturesParams) -> PointsList:
     '''
     Find matching points in a set of two images for every combination.
 
@@ -252,6 +521,10 @@ def get_points(imgs: ImageList, ic_list: CombinationsList) -> PointsList:
     ----------
     imgs : ImageList
         List of image matrices
+    ic_list : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
 
     Returns
     -------
@@ -260,25 +533,97 @@ def get_points(imgs: ImageList, ic_list: CombinationsList) -> PointsList:
     '''
     points_list = []
 
-    kp_list = get_keypoints(imgs, ic_list)
-    mk_list = match_keypoints(kp_list)
+    kp_list = get_keypoints(imgs, ic_list, params)
+    mk_list = match_keypoints(kp_list, params)
     fm_list = filter_matches(kp_list, mk_list)
 
-    for i, k in enumerate(kp_list):
-        points_list.append(
-            (
-                k[0][0],
-                k[0][1],
-                mk_list[i][0],
-                fm_list[i][2],
-                k[2]
-            )
-        )
+    for kd, mk, corr in zip(kp_list, mk_list, fm_list):
+        points_list.append(Points(kd.left, kd.right, mk, corr.matches_mask, kd.combi))
 
     return points_list
 
 
-def get_fundamental_matrices(imgs: ImageList, ic_list: CombinationsList) -> FundamentalMatricesList:
+def iter_fundamental_matrices(
+    imgs: ImageList,
+    ic_list: CombinationsList,
+    params: FeaturesParams
+) -> Iterator[FundamentalMatrix]:
+    '''
+    Take one combination at a time through keypoint extraction, matching, filtering and fundamental matrix estimation
+    and yield the result. Keypoints, descriptors and trained matchers of an image are dropped as soon as no later
+    combination uses the image, so peak memory is bounded by one combination instead of all of them.
+
+    Combinations which are already stored in the pose graph are read from disk and skip keypoint extraction and
+    matching completely. Newly computed combinations are added to the pose graph.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    ic_list : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
+
+    Returns
+    -------
+    fm_iter : Iterator[FundamentalMatrix]
+        The fundamental matrix for each combination
+    '''
+    kd_cache: KeypointDescriptorCache = {}
+    matchers: Dict[int, cv.DescriptorMatcher] = {}
+
+    # Indices of the combinations which still need to be computed
+    pending: List[int] = []
+    for i, c in enumerate(ic_list):
+        if not params['use_store'] or not posegraph.contains(imgs[c[0]][1], imgs[c[1]][1], params):
+            pending.append(i)
+
+    # Index of the last combination each image is used in
+    last_use: Dict[int, int] = {}
+    for i in pending:
+        for index in ic_list[i]:
+            last_use[index] = i
+
+    # With multiple workers, extract the features of all images in parallel up front
+    if params['workers'] > 1 and len(pending) > 0:
+        get_keypoints(imgs, [ic_list[i] for i in pending], params, kd_cache)
+
+    pending_set = set(pending)
+
+    for i, c in enumerate(ic_list):
+        path_l, path_r = imgs[c[0]][1], imgs[c[1]][1]
+
+        if i not in pending_set:
+            fm, ok = posegraph.load_fundamental(path_l, path_r, params, tuple(c))
+            if ok:
+                profile.count('posegraph_hits')
+                profile.pair(c, inliers=fm.corr.inliers)
+                yield fm
+                continue
+
+        kp_list = get_keypoints(imgs, [c], params, kd_cache)
+        mk_list = match_keypoints(kp_list, params, matchers=matchers)
+        fm_list = filter_matches(kp_list, mk_list)
+        fm = find_fundamental_matrices(fm_list, params['ransac'])[0]
+
+        if params['use_store']:
+            posegraph.save_fundamental(path_l, path_r, params, fm)
+
+        yield fm
+
+        # Drop everything which isn't used by any of the following combinations
+        for index in c:
+            if last_use.get(index, -1) <= i:
+                kd_cache.pop(index, None)
+                matchers.pop(index, None)
+
+
+def get_fundamental_matrices(
+    imgs: ImageList,
+    ic_list: CombinationsList,
+    params: FeaturesParams
+) -> FundamentalMatricesList:
     '''
     Get the fundamental matrix for each of the combinations.
 
@@ -286,14 +631,63 @@ def get_fundamental_matrices(imgs: ImageList, ic_list: CombinationsList) -> Fund
     ----------
     img : ImageList
         List of images (matrices)
+    ic_list : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
 
     Returns
     -------
     fm_list : FundamentalMatricesList
         A list of fundamental matrices
     '''
-    kp_list = get_keypoints(imgs, ic_list)
-    mk_list = match_keypoints(kp_list)
-    fm_list = filter_matches(kp_list, mk_list)
-    fm_list = find_fundamental_matrices(fm_list)
-    return fm_list
+    return list(iter_fundamental_matrices(imgs, ic_list, params))
+
+
+def get_essential_matrices(
+    imgs: ImageList,
+    ic_list: CombinationsList,
+    params: FeaturesParams,
+    intrinsic_matrix: np.ndarray
+) -> Tuple[FundamentalMatricesList, EssentialMatricesList]:
+    '''
+    Get the fundamental and essential matrix for each of the combinations. Both are read from the pose graph if
+    possible, so only combinations with new images are computed.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    ic_list : CombinationsList
+        List of image combinations
+    params : FeaturesParams
+        Feature extraction params
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+
+    Returns
+    -------
+    fm_list : FundamentalMatricesList
+        A list of fundamental matrices
+    em_list : EssentialMatricesList
+        List of essential matrices and decomposed matrix values
+    '''
+    fm_list = get_fundamental_matrices(imgs, ic_list, params)
+    em_list: EssentialMatricesList = []
+
+    for fm in fm_list:
+        path_l, path_r = imgs[fm.combi[0]][1], imgs[fm.combi[1]][1]
+
+        em: EssentialMatrix = None
+        ok = False
+        if params['use_store']:
+            em, ok = posegraph.load_essential(path_l, path_r, params, intrinsic_matrix, fm.combi)
+
+        if not ok:
+            em = find_essential_matrices([fm], intrinsic_matrix)[0]
+            if params['use_store']:
+                posegraph.save_essential(path_l, path_r, params, intrinsic_matrix, em)
+
+        em_list.append(em)
+
+    return fm_list, em_list
@@ -0,0 +1,192 @@
+from datetime import datetime
+from typing import List, Set, Tuple
+import numpy as np
+import cv2 as cv
+
+from thints.images import ImageList, CombinationsList
+from thints.features import FeaturesParams
+import features.features as features
+import features.detectors as detectors
+import utils.images as images
+import exif.exif as exif
+
+# Number of visual words of the bag-of-visual-words vocabulary
+VOCABULARY_SIZE = 64
+
+# Maximum number of descriptors the vocabulary is clustered from
+VOCABULARY_SAMPLES = 20000
+
+# Format of the EXIF capture time
+EXIF_TIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+
+def descriptor_vectors(des: np.ndarray, binary: bool) -> np.ndarray:
+    '''
+    Convert descriptors into float32 vectors. Binary descriptors are unpacked into bits, so that the L2 distance
+    between the vectors is the Hamming distance of the descriptors.
+    '''
+    if des is None or len(des) == 0:
+        return np.empty((0, 0), np.float32)
+
+    if binary:
+        return np.float32(np.unpackbits(des, axis=1))
+
+    return np.float32(des)
+
+
+def bovw_histograms(imgs: ImageList, params: FeaturesParams, words: int = VOCABULARY_SIZE) -> np.ndarray:
+    '''
+    Compute a bag-of-visual-words histogram for each image. The vocabulary is clustered via k-means from a sample of
+    the descriptors of all images. Descriptors are read from the feature store if possible, so the features of the
+    following matching step are already available. The histograms are tf-idf weighted and L2 normalized.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images
+    params : FeaturesParams
+        Feature extraction params
+    words : int
+        Number of visual words (Default: VOCABULARY_SIZE)
+
+    Returns
+    -------
+    histograms : np.ndarray
+        NxW float32 histograms
+    '''
+    binary = detectors.is_binary(params['detector'])
+    kd_arrays = features.detect_all(imgs, list(range(len(imgs))), params)
+    vectors = [descriptor_vectors(kd_arrays[i][1], binary) for i in range(len(imgs))]
+
+    samples = np.concatenate([v for v in vectors if len(v) > 0])
+    if len(samples) > VOCABULARY_SAMPLES:
+        samples = samples[np.random.default_rng(0).choice(len(samples), VOCABULARY_SAMPLES, replace=False)]
+
+    # Seed OpenCV's RNG, so the same images always result in the same vocabulary
+    cv.setRNGSeed(0)
+    words = min(words, len(samples))
+    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, vocabulary = cv.kmeans(samples, words, None, criteria, 1, cv.KMEANS_PP_CENTERS)
+
+    matcher = cv.BFMatcher(cv.NORM_L2)
+    histograms = np.zeros((len(imgs), words), np.float32)
+
+    for i, v in enumerate(vectors):
+        if len(v) == 0:
+            continue
+
+        assigned = [m.trainIdx for m in matcher.match(v, vocabulary)]
+        histograms[i] = np.bincount(assigned, minlength=words)
+
+    # Words which occur in many images don't tell images apart, so they are weighted down (smoothed idf)
+    idf = np.log((1.0 + len(imgs)) / (1.0 + np.count_nonzero(histograms, axis=0))) + 1.0
+    histograms *= np.float32(idf)
+
+    norms = np.linalg.norm(histograms, axis=1, keepdims=True)
+    return histograms / np.maximum(norms, 1e-12)
+
+
+def capture_times(imgs: ImageList) -> Tuple[np.ndarray, bool]:
+    '''
+    Read the EXIF capture time of each image.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images
+
+    Returns
+    -------
+    times : np.ndarray
+        Capture times as POSIX timestamps
+    ok : bool
+        False if any of the images has no (valid) capture time
+    '''
+    times: List[float] = []
+
+    for _, path in imgs:
+        tags, err = exif.read(path)
+        if err != None:
+            return None, False
+
+        value, err = exif.get('EXIF DateTimeOriginal', tags)
+        if err != None:
+            return None, False
+
+        try:
+            times.append(datetime.strptime(value, EXIF_TIME_FORMAT).timestamp())
+        except ValueError:
+            return None, False
+
+    return np.array(times), True
+
+
+def similarity_matrix(imgs: ImageList, params: FeaturesParams) -> np.ndarray:
+    '''
+    Return the NxN similarity of all images. With the 'time' ranking, images captured close together are similar. If
+    an image has no capture time, or with the 'bovw' ranking, the cosine similarity of the bag-of-visual-words
+    histograms is used.
+    '''
+    if params['ranking'] == 'time':
+        times, ok = capture_times(imgs)
+        if ok:
+            return -np.abs(times[:, np.newaxis] - times[np.newaxis, :])
+
+    histograms = bovw_histograms(imgs, params)
+    return histograms @ histograms.T
+
+
+def top_k_combinations(similarity: np.ndarray, k: int) -> CombinationsList:
+    '''
+    Return the combinations of each image with its 'k' most similar images. Combinations selected by both images are
+    only returned once.
+
+    Parameters
+    ----------
+    similarity : np.ndarray
+        NxN similarity of all images
+    k : int
+        Number of neighbours per image
+
+    Returns
+    -------
+    combis : CombinationsList
+        A list of combinations
+    '''
+    pairs: Set[Tuple[int, int]] = set()
+
+    for i, row in enumerate(similarity):
+        # Stable sort, so ties are broken by the image order
+        order = [j for j in np.argsort(-row, kind='stable') if j != i]
+        for j in order[:k]:
+            pairs.add((min(i, int(j)), max(i, int(j))))
+
+    return [list(p) for p in sorted(pairs)]
+
+
+def get_combinations(imgs: ImageList, combi_mode: int, ref_index: int, params: FeaturesParams) -> CombinationsList:
+    '''
+    Return the image combinations for 'combi_mode'. Mode 3 ranks all candidate pairs cheaply and only combines each
+    image with its 'top_k' most similar images, instead of all O(N^2) combinations. All other modes are handled by
+    images.get_combinations.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images
+    combi_mode : int
+        Combination mode
+    ref_index : int
+        Index of the reference image
+    params : FeaturesParams
+        Feature extraction params
+
+    Returns
+    -------
+    combis : CombinationsList
+        A list of combinations
+    '''
+    if combi_mode != 3:
+        return images.get_combinations(imgs, combi_mode, ref_index)
+
+    return top_k_combinations(similarity_matrix(imgs, params), params['top_k'])
@@ -0,0 +1,205 @@
+from typing import Dict, Tuple
+import numpy as np
+import os
+
+from thints.features import Correspondences, EssentialMatrix, FeaturesParams, FundamentalMatrix
+import features.detectors as detectors
+import utils.cache as cache
+
+# Arrays of the two-view geometry of an edge
+FUNDAMENTAL_FIELDS = ('fundamental', 'pts_l', 'pts_r', 'inliers')
+
+# Arrays of the relative pose of an edge
+ESSENTIAL_FIELDS = ('essential', 'r1', 'r2', 't', 'intrinsic')
+
+
+def edge_params(params: FeaturesParams) -> str:
+    '''
+    Return the part of the edge key which describes the params the geometry of an edge was computed with.
+    '''
+    key = '{}-{}'.format(detectors.key(params['detector'], params['scale']), params['matcher'])
+    if params['cross_check']:
+        key += '-cc'
+
+    ransac = params['ransac']
+    key += '-{}-{:g}-{:g}-{}'.format(ransac['method'], ransac['threshold'], ransac['confidence'], ransac['max_iters'])
+
+    return key
+
+
+def key(path_l: str, path_r: str, params: FeaturesParams) -> str:
+    '''
+    Return the pose graph key of the edge between the images at 'path_l' and 'path_r'. The key consists of the hashes
+    of both images and the feature params, so renamed or moved images still hit the pose graph while changed images
+    or params miss it.
+
+    Parameters
+    ----------
+    path_l : str
+        Path to the left image
+    path_r : str
+        Path to the right image
+    params : FeaturesParams
+        Feature extraction params
+
+    Returns
+    -------
+    key : str
+        The edge key
+    '''
+    return '{}-{}-{}'.format(cache.cached_file_hash(path_l), cache.cached_file_hash(path_r), edge_params(params))
+
+
+def edge_path(path_l: str, path_r: str, params: FeaturesParams) -> str:
+    '''
+    Return the path of the edge file. The pose graph is located in the '.cache/posegraph' folder next to the images.
+    '''
+    return os.path.join(cache.cache_dir(os.path.dirname(path_l), 'posegraph'), key(path_l, path_r, params) + '.npz')
+
+
+def read(path_l: str, path_r: str, params: FeaturesParams) -> Tuple[Dict[str, np.ndarray], bool]:
+    '''
+    Read all arrays of the edge between the images at 'path_l' and 'path_r'.
+    '''
+    try:
+        entry = edge_path(path_l, path_r, params)
+        if not os.path.exists(entry):
+            return {}, False
+
+        with np.load(entry, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}, True
+    except:
+        return {}, False
+
+
+def write(path_l: str, path_r: str, params: FeaturesParams, arrays: Dict[str, np.ndarray]) -> bool:
+    '''
+    Write the arrays of the edge between the images at 'path_l' and 'path_r'. The file is replaced atomically, so an
+    interrupted run never leaves a broken edge behind.
+    '''
+    try:
+        entry = edge_path(path_l, path_r, params)
+        tmp = '{}.{}.tmp.npz'.format(entry, os.getpid())
+        np.savez(tmp, **arrays)
+        os.replace(tmp, entry)
+    except:
+        return False
+
+    return True
+
+
+def contains(path_l: str, path_r: str, params: FeaturesParams) -> bool:
+    '''
+    Return if the pose graph contains the edge between the images at 'path_l' and 'path_r'.
+    '''
+    try:
+        return os.path.exists(edge_path(path_l, path_r, params))
+    except:
+        return False
+
+
+def load_fundamental(
+    path_l: str,
+    path_r: str,
+    params: FeaturesParams,
+    combi: Tuple[int, int]
+) -> Tuple[FundamentalMatrix, bool]:
+    '''
+    Load the fundamental matrix and the correspondences of the edge between the images at 'path_l' and 'path_r'.
+
+    Parameters
+    ----------
+    path_l : str
+        Path to the left image
+    path_r : str
+        Path to the right image
+    params : FeaturesParams
+        Feature extraction params
+    combi : Tuple[int, int]
+        Combination the edge is loaded for
+
+    Returns
+    -------
+    fm : FundamentalMatrix
+        The fundamental matrix and the correspondences with the inliers in front
+    ok : bool
+        False if there is no (readable) edge in the pose graph
+    '''
+    arrays, ok = read(path_l, path_r, params)
+    if not ok or not all(name in arrays for name in FUNDAMENTAL_FIELDS):
+        return None, False
+
+    corr = Correspondences(arrays['pts_l'], arrays['pts_r'], combi, int(arrays['inliers']))
+    return FundamentalMatrix(arrays['fundamental'], corr), True
+
+
+def save_fundamental(path_l: str, path_r: str, params: FeaturesParams, fm: FundamentalMatrix) -> bool:
+    '''
+    Save the fundamental matrix and the correspondences of the edge between the images at 'path_l' and 'path_r'. A
+    relative pose which is already stored for this edge is dropped.
+    '''
+    if fm.f is None:
+        return False
+
+    arrays = (fm.f, fm.corr.pts_l, fm.corr.pts_r, np.int64(fm.corr.inliers))
+    return write(path_l, path_r, params, dict(zip(FUNDAMENTAL_FIELDS, arrays)))
+
+
+def load_essential(
+    path_l: str,
+    path_r: str,
+    params: FeaturesParams,
+    intrinsic_matrix: np.ndarray,
+    combi: Tuple[int, int]
+) -> Tuple[EssentialMatrix, bool]:
+    '''
+    Load the essential matrix and its decomposition of the edge between the images at 'path_l' and 'path_r'. The
+    stored pose is only used if it was computed with the same intrinsic camera matrix.
+
+    Parameters
+    ----------
+    path_l : str
+        Path to the left image
+    path_r : str
+        Path to the right image
+    params : FeaturesParams
+        Feature extraction params
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+    combi : Tuple[int, int]
+        Combination the edge is loaded for
+
+    Returns
+    -------
+    em : EssentialMatrix
+        The essential matrix, both possible rotations and the translation
+    ok : bool
+        False if there is no (matching) pose in the pose graph
+    '''
+    arrays, ok = read(path_l, path_r, params)
+    if not ok or not all(name in arrays for name in ESSENTIAL_FIELDS):
+        return None, False
+
+    if not np.allclose(arrays['intrinsic'], intrinsic_matrix):
+        return None, False
+
+    return EssentialMatrix(arrays['essential'], arrays['r1'], arrays['r2'], arrays['t'], combi), True
+
+
+def save_essential(
+    path_l: str,
+    path_r: str,
+    params: FeaturesParams,
+    intrinsic_matrix: np.ndarray,
+    em: EssentialMatrix
+) -> bool:
+    '''
+    Add the essential matrix and its decomposition to the edge between the images at 'path_l' and 'path_r'. The edge
+    needs to contain the fundamental matrix already.
+    '''
+    arrays, ok = read(path_l, path_r, params)
+    if not ok or em.e is None:
+        return False
+
+    arrays.update(zip(ESSENTIAL_FIELDS, (em.e, em.r1, em.r2, em.t, intrinsic_matrix)))
+    return write(path_l, path_r, params, arrays)
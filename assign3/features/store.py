@@ -0,0 +1,120 @@
+from typing import List, Tuple
+import numpy as np
+import cv2 as cv
+import os
+
+import utils.cache as cache
+
+# Columns of the keypoint arrays saved in the store
+KEYPOINT_ATTRIBUTES = ('x', 'y', 'size', 'angle', 'response', 'octave')
+
+
+def keypoints_to_array(kpoints: List[cv.KeyPoint]) -> np.ndarray:
+    '''
+    Convert a list of OpenCV keypoints into a Nx6 float32 array with the columns listed in KEYPOINT_ATTRIBUTES.
+
+    Parameters
+    ----------
+    kpoints : List[cv.KeyPoint]
+        List of keypoints
+
+    Returns
+    -------
+    arr : np.ndarray
+        Nx6 float32 array of keypoint attributes
+    '''
+    arr = np.empty((len(kpoints), len(KEYPOINT_ATTRIBUTES)), np.float32)
+    for i, kp in enumerate(kpoints):
+        arr[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response, kp.octave)
+
+    return arr
+
+
+def key(path: str, detector: str) -> str:
+    '''
+    Return the store key for the image at 'path'. The key consists of the hash of the file content and the detector
+    parameters, so renamed or moved images still hit the store while changed images or parameters miss it.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    detector : str
+        Detector name including its parameters, e.g. 'sift-500'
+
+    Returns
+    -------
+    key : str
+        The store key
+    '''
+    return '{}-{}'.format(cache.cached_file_hash(path), detector)
+
+
+def store_path(path: str) -> str:
+    '''
+    Return the feature store directory for the image at 'path'. The store is located in the '.cache/features' folder
+    next to the image.
+    '''
+    return cache.cache_dir(os.path.dirname(path), 'features')
+
+
+def load(path: str, detector: str) -> Tuple[Tuple[np.ndarray, np.ndarray], bool]:
+    '''
+    Load keypoints and descriptors of the image at 'path' from the feature store.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    detector : str
+        Detector name including its parameters
+
+    Returns
+    -------
+    result : Tuple[np.ndarray, np.ndarray]
+        Nx6 keypoint attribute array and the descriptor matrix
+    ok : bool
+        False if there is no (readable) entry in the store
+    '''
+    try:
+        entry = os.path.join(store_path(path), key(path, detector) + '.npz')
+        if not os.path.exists(entry):
+            return (None, None), False
+
+        with np.load(entry, allow_pickle=False) as data:
+            return (data['keypoints'], data['descriptors']), True
+    except:
+        return (None, None), False
+
+
+def save(path: str, detector: str, kpoints: np.ndarray, des: np.ndarray) -> bool:
+    '''
+    Save keypoints and descriptors of the image at 'path' in the feature store. The entry is replaced atomically.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    detector : str
+        Detector name including its parameters
+    kpoints : np.ndarray
+        Nx6 keypoint attribute array
+    des : np.ndarray
+        Descriptor matrix
+
+    Returns
+    -------
+    ok : bool
+        Status of this function
+    '''
+    try:
+        entry = os.path.join(store_path(path), key(path, detector) + '.npz')
+
+        # Write to a temporary file first, so an interrupted run or a concurrent reader never sees a partial entry
+        tmp = '{}.{}.tmp.npz'.format(entry, os.getpid())
+        np.savez(tmp, keypoints=kpoints, descriptors=des)
+        os.replace(tmp, entry)
+    except:
+        return False
+
+    return True
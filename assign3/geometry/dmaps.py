@@ -1,11 +1,312 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterable, Iterator, List, Tuple
+from collections import deque
+import threading
+import time
 import numpy as np
 import cv2 as cv
 
-from thints.geometry import DepthMapsList, RectificationMatricesList, SGBMParams
+from thints.geometry import DepthMap, DepthMapsList, Rectification, SGBMParams
 from thints.images import ImageList
+import geometry.rectification as grect
+import utils.profile as profile
 
+# Bytes per element of the (16-bit) SGBM cost buffers
+COST_BYTES = 2
 
-def depth_maps(imgs: ImageList, rm_list: RectificationMatricesList, sgbm_params: SGBMParams) -> DepthMapsList:
+# Number of path directions whose aggregated costs SGBM keeps per row
+SGBM_PATHS = 8
+
+# Bytes per pixel of the 16-bit disparity output of SGBM
+SGBM_PIXEL_BYTES = 2
+
+# Bytes per pixel of the speckle filter buffers (label, point stack and region type)
+SPECKLE_PIXEL_BYTES = 9
+
+# Bytes per pixel of the stitched 16-bit disparity of the tiled mode
+DISP_BYTES = 2
+
+# Bytes per megabyte, used to convert the --max-mem budget
+ONE_MB_IN_BYTES = 1024 * 1024
+
+# Tile size, disparity margin (in pixels) and the percentiles of the coarse disparities spanning the search window of
+# each tile in the pyramid mode
+PYRAMID_TILE_SIZE = 512
+PYRAMID_MARGIN = 4
+PYRAMID_PERCENTILES = (2, 98)
+
+
+def strip_overlap(sgbm_params: SGBMParams) -> int:
+    '''
+    Return the number of rows each strip overlaps its neighbours: the block size plus the disparity range.
+    '''
+    return sgbm_params['blockSize'] + sgbm_params['numDisparities']
+
+
+def sgbm_bytes(width: int, rows: int, sgbm_params: SGBMParams) -> int:
+    '''
+    Estimate the peak memory (in bytes) of semi global matching on an image with 'width' x 'rows' pixels. The default
+    MODE_SGBM only keeps the cost buffers of a few rows: the aggregated costs of all path directions and the block
+    sums of blockSize rows. Only MODE_HH keeps the costs of the whole image, width x rows x numDisparities. Per pixel,
+    SGBM needs the disparity output and the buffers of the speckle filter (if enabled).
+
+    Parameters
+    ----------
+    width : int
+        Width of the images
+    rows : int
+        Number of rows
+    sgbm_params : SGBMParams
+        Semi global matching params
+
+    Returns
+    -------
+    size : int
+        Estimated peak memory in bytes
+    '''
+    disparities = sgbm_params['numDisparities']
+
+    # Aggregated path costs (with a 16 disparity border) and the block sums are kept per row
+    path_costs = (disparities + 16) * SGBM_PATHS
+    block_sums = disparities * (sgbm_params['blockSize'] + 2)
+    line_bytes = width * COST_BYTES * (path_costs + block_sums)
+
+    # Matching and aggregated costs of the whole image
+    cost_bytes = 0
+    if sgbm_params.get('mode', cv.STEREO_SGBM_MODE_SGBM) == cv.STEREO_SGBM_MODE_HH:
+        cost_bytes = 2 * width * rows * disparities * COST_BYTES
+
+    pixel_bytes = SGBM_PIXEL_BYTES
+    if sgbm_params['speckleWindowSize'] > 0:
+        pixel_bytes += SPECKLE_PIXEL_BYTES
+
+    return line_bytes + cost_bytes + width * rows * pixel_bytes
+
+
+def strip_height(
+    width: int,
+    height: int,
+    sgbm_params: SGBMParams,
+    max_mem: int,
+    workers: int
+) -> Tuple[int, bool]:
+    '''
+    Return the number of rows per strip, so that 'workers' concurrently computed strips (including their overlap) fit
+    into 'max_mem' bytes, see sgbm_bytes. The stitched disparity of the whole image is part of the budget as well. If
+    the whole image fits into the budget, no tiling is needed and 'height' is returned.
+
+    Parameters
+    ----------
+    width : int
+        Width of the images
+    height : int
+        Height of the images
+    sgbm_params : SGBMParams
+        Semi global matching params
+    max_mem : int
+        Memory budget in bytes
+    workers : int
+        Number of strips computed concurrently
+
+    Returns
+    -------
+    rows : int
+        Number of rows per strip (without overlap)
+    ok : bool
+        False if not even a strip of blockSize rows plus its overlap fits into the budget
+    '''
+    if sgbm_bytes(width, height, sgbm_params) <= max_mem:
+        return height, True
+
+    budget = (max_mem - width * height * DISP_BYTES) // max(workers, 1)
+    overlap = 2 * strip_overlap(sgbm_params)
+
+    # Find the highest strip which fits, the estimate grows linearly with the number of rows
+    fixed = sgbm_bytes(width, 0, sgbm_params)
+    per_row = sgbm_bytes(width, 1, sgbm_params) - fixed
+    rows = (budget - fixed) // per_row - overlap if budget > fixed else 0
+
+    if rows < sgbm_params['blockSize']:
+        return 0, False
+
+    return min(rows, height), True
+
+
+def min_budget(width: int, height: int, sgbm_params: SGBMParams, workers: int) -> int:
+    '''
+    Return the smallest memory budget (in bytes) strip_height accepts for images with 'width' x 'height' pixels and
+    'workers' threads.
+    '''
+    rows = sgbm_params['blockSize'] + 2 * strip_overlap(sgbm_params)
+    strips = max(workers, 1) * sgbm_bytes(width, rows, sgbm_params) + width * height * DISP_BYTES
+
+    return min(strips, sgbm_bytes(width, height, sgbm_params))
+
+
+def strip_disparity(
+    img_l: cv.Mat,
+    img_r: cv.Mat,
+    strip: Tuple[int, int],
+    sgbm_params: SGBMParams,
+    local: threading.local,
+    out: np.ndarray
+):
+    '''
+    Compute the raw disparity of the rows 'strip' (start, end) and write it into the same rows of 'out'. The strip is
+    extended by the overlap on both sides for matching and cropped back afterwards.
+    '''
+    if not hasattr(local, 'stereo_sgbm'):
+        local.stereo_sgbm = cv.StereoSGBM_create(**sgbm_params)
+
+    overlap = strip_overlap(sgbm_params)
+    top = max(strip[0] - overlap, 0)
+    bottom = min(strip[1] + overlap, img_l.shape[0])
+
+    disp = local.stereo_sgbm.compute(img_l[top:bottom], img_r[top:bottom])
+    out[strip[0]:strip[1]] = disp[strip[0] - top:strip[1] - top]
+
+
+def tiled_disparity(img_l: cv.Mat, img_r: cv.Mat, sgbm_params: SGBMParams, max_mem: int, workers: int) -> np.ndarray:
+    '''
+    Compute the raw disparity of a rectified image pair in horizontal strips. The strips overlap by the block size
+    plus the disparity range, are computed concurrently by 'workers' threads and are stitched back together. The
+    strip height is chosen so that peak memory stays within the 'max_mem' budget. If the whole pair fits into the
+    budget, it is matched in one piece. If not even the smallest strip fits, the pair is matched in one piece as well,
+    as thin strips would mostly compute their overlap. Use min_budget to check the budget up front.
+
+    Parameters
+    ----------
+    img_l : cv.Mat
+        Rectified left image
+    img_r : cv.Mat
+        Rectified right image
+    sgbm_params : SGBMParams
+        Semi global matching params
+    max_mem : int
+        Memory budget in bytes
+    workers : int
+        Number of worker threads
+
+    Returns
+    -------
+    disp : np.ndarray
+        Raw (16-bit fixed-point) disparity
+    '''
+    height, width = img_l.shape[:2]
+    rows, ok = strip_height(width, height, sgbm_params, max_mem, workers)
+    if not ok or rows >= height:
+        return cv.StereoSGBM_create(**sgbm_params).compute(img_l, img_r)
+
+    # Strips are written into the stitched disparity directly, so it is never copied
+    disp = np.empty((height, width), np.int16)
+    strips: List[Tuple[int, int]] = [(y, min(y + rows, height)) for y in range(0, height, rows)]
+    local = threading.local()
+
+    if workers <= 1:
+        for strip in strips:
+            strip_disparity(img_l, img_r, strip, sgbm_params, local, disp)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda strip: strip_disparity(img_l, img_r, strip, sgbm_params, local, disp), strips))
+
+    return disp
+
+
+def depth_map(
+    imgs: ImageList,
+    rm: Rectification,
+    sgbm_params: SGBMParams,
+    local: threading.local,
+    max_mem: int = 0,
+    workers: int = 1
+) -> DepthMap:
+    '''
+    Compute the depth map of a single image combination via semi global matching. Both images are rectified first.
+    Each thread uses its own matcher instance, which is stored in the thread local storage 'local'. If 'max_mem' is
+    set, the disparity is computed in strips by 'workers' threads, see tiled_disparity.
+    '''
+    with profile.stage('depth_maps', rm.combi):
+        img_l, img_r = grect.rectify_images(imgs, rm)
+
+        if max_mem > 0:
+            disp_sgbm = tiled_disparity(img_l, img_r, sgbm_params, max_mem, workers)
+        else:
+            if not hasattr(local, 'stereo_sgbm'):
+                local.stereo_sgbm = cv.StereoSGBM_create(**sgbm_params)
+
+            disp_sgbm = local.stereo_sgbm.compute(img_l, img_r)
+
+        raw = raw_to_pixels(disp_sgbm, sgbm_params['minDisparity'])
+        disp_sgbm = cv.normalize(disp_sgbm.astype(np.float32), None, 0, 255, cv.NORM_MINMAX)
+
+    return DepthMap(disp_sgbm, raw, rm.combi)
+
+
+def iter_depth_maps(
+    imgs: ImageList,
+    rm_iter: Iterable[Rectification],
+    sgbm_params: SGBMParams,
+    workers: int = 1,
+    max_mem: int = 0
+) -> Iterator[DepthMap]:
+    '''
+    Compute depth maps for each image combination via semi global matching and yield them one at a time. With more
+    than one worker, up to 'workers' combinations are computed concurrently in a thread pool (OpenCV releases the GIL
+    while computing). Depth maps are always yielded in combination order.
+
+    If a memory budget 'max_mem' (in MB) is set, combinations are processed one after another instead and the
+    workers compute the strips of each combination concurrently, see tiled_disparity.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    rm_iter : Iterable[Rectification]
+        Rectification matrices for each combination
+    sgbm_params : SGBMParams
+        Semi global matching params
+    workers : int
+        Number of worker threads (Default: 1)
+    max_mem : int
+        Memory budget in MB. 0 disables the tiled mode (Default: 0)
+
+    Returns
+    -------
+    dm_iter : Iterator[DepthMap]
+        Depth map for each combination
+    '''
+    local = threading.local()
+
+    if max_mem > 0:
+        for rm in rm_iter:
+            yield depth_map(imgs, rm, sgbm_params, local, max_mem * ONE_MB_IN_BYTES, workers)
+        return
+
+    if workers <= 1:
+        for rm in rm_iter:
+            yield depth_map(imgs, rm, sgbm_params, local)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep at most 'workers' combinations in flight and yield them in submission order
+        pending: Deque[Future] = deque()
+        for rm in rm_iter:
+            pending.append(pool.submit(depth_map, imgs, rm, sgbm_params, local))
+
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def depth_maps(
+    imgs: ImageList,
+    rm_list: Iterable[Rectification],
+    sgbm_params: SGBMParams,
+    workers: int = 1,
+    max_mem: int = 0
+) -> DepthMapsList:
     '''
     Compute depth maps for each image combination via semi global matching.
 
@@ -13,42 +314,280 @@ def depth_maps(imgs: ImageList, rm_list: RectificationMatricesList, sgbm_params:
     ----------
     imgs : ImageList
         List of images (matrices)
-    rm_list : RectificationMatricesList
+    rm_list : Iterable[Rectification]
         List of rectification matrices
     sgbm_params : SGBMParams
         Semi global matching params
+    workers : int
+        Number of worker threads (Default: 1)
+    max_mem : int
+        Memory budget in MB. 0 disables the tiled mode (Default: 0)
 
     Returns
     -------
     maps_list : DepthMapsList
         List of depth maps for each combination
     '''
-    maps_list: DepthMapsList = []
+    return list(iter_depth_maps(imgs, rm_list, sgbm_params, workers, max_mem))
+
+
+def disparity_window(coarse: np.ndarray, sgbm_params: SGBMParams) -> Tuple[int, int]:
+    '''
+    Return the disparity search window (minDisparity, numDisparities) for a tile based on the upscaled disparities
+    'coarse' of the previous pyramid level. The window spans the PYRAMID_PERCENTILES of the coarse disparities, so
+    single outliers don't widen it, is extended by PYRAMID_MARGIN and clamped to the full range. If there are no valid
+    coarse disparities, the full range is returned.
+    '''
+    full_min = sgbm_params['minDisparity']
+    full_max = full_min + sgbm_params['numDisparities']
+
+    valid = coarse[np.isfinite(coarse)]
+    if len(valid) == 0:
+        return full_min, sgbm_params['numDisparities']
+
+    lower, upper = np.percentile(valid, PYRAMID_PERCENTILES)
+    lo = max(int(np.floor(lower)) - PYRAMID_MARGIN, full_min)
+    hi = min(int(np.ceil(upper)) + PYRAMID_MARGIN, full_max)
+
+    # numDisparities has to be a positive multiple of 16
+    num = max(int(np.ceil((hi - lo) / 16.0)) * 16, 16)
+
+    return lo, num
+
+
+def tile_crop(
+    shape: Tuple[int, int],
+    tile: Tuple[int, int, int, int],
+    min_disp: int,
+    num_disp: int,
+    block_size: int
+) -> Tuple[int, int, int, int]:
+    '''
+    Return the crop (top, bottom, left, right) of both images which is needed to match the tile (top, bottom, left,
+    right) with the search window (min_disp, num_disp). The crop adds blockSize rows to each side of the tile in y. In
+    x it adds the columns SGBM leaves invalid on the left and the columns reachable with negative disparities on the
+    right.
+    '''
+    y0, y1, x0, x1 = tile
+
+    top = max(y0 - block_size, 0)
+    bottom = min(y1 + block_size, shape[0])
+    left = max(x0 - min_disp - num_disp - block_size, 0)
+    right = min(x1 + block_size + max(-min_disp, 0), shape[1])
+
+    return top, bottom, left, right
+
+
+def window_disparity(
+    img_l: cv.Mat,
+    img_r: cv.Mat,
+    tile: Tuple[int, int, int, int],
+    window: Tuple[int, int],
+    sgbm_params: SGBMParams
+) -> np.ndarray:
+    '''
+    Compute the disparity (in pixels, invalid pixels are NaN) of the tile (top, bottom, left, right) with the search
+    window (minDisparity, numDisparities). Both images are cropped to the tile plus the margin of tile_crop.
+    '''
+    y0, y1, x0, x1 = tile
+    min_disp, num_disp = window
+
+    params: SGBMParams = dict(sgbm_params, minDisparity=min_disp, numDisparities=num_disp)
+    top, bottom, left, right = tile_crop(img_l.shape[:2], tile, min_disp, num_disp, params['blockSize'])
+
+    disp = cv.StereoSGBM_create(**params).compute(img_l[top:bottom, left:right], img_r[top:bottom, left:right])
+    return raw_to_pixels(disp[y0 - top:y1 - top, x0 - left:x1 - left], min_disp)
+
+
+def raw_to_pixels(disp: np.ndarray, min_disp: int) -> np.ndarray:
+    '''
+    Convert a raw (16-bit fixed-point) SGBM disparity into a float32 disparity in pixels. Invalid pixels are NaN.
+    '''
+    pixels = disp.astype(np.float32) / 16.0
+    pixels[disp < min_disp * 16] = np.nan
+
+    return pixels
+
+
+def tiled_work(
+    shape: Tuple[int, int],
+    tiles: List[Tuple[int, int, int, int]],
+    windows: List[Tuple[int, int]],
+    sgbm_params: SGBMParams
+) -> int:
+    '''
+    Return the number of matching costs (cropped pixels times disparities) of the tiles with their search windows.
+    '''
+    work = 0
+    for tile, (min_disp, num_disp) in zip(tiles, windows):
+        top, bottom, left, right = tile_crop(shape, tile, min_disp, num_disp, sgbm_params['blockSize'])
+        work += (bottom - top) * (right - left) * num_disp
+
+    return work
+
+
+def pyramid_disparity(
+    img_l: cv.Mat,
+    img_r: cv.Mat,
+    sgbm_params: SGBMParams,
+    levels: int,
+    workers: int = 1
+) -> Tuple[np.ndarray, List[float]]:
+    '''
+    Compute the disparity of a rectified image pair coarse-to-fine. The full disparity range is only searched on the
+    coarsest level of an image pyramid. On every finer level, the upscaled disparity of the previous level limits the
+    search window of each tile. Tiles are computed concurrently by 'workers' threads. Levels whose tile windows don't
+    narrow the search (e.g. scenes with a large depth range within each tile) fall back to plain SGBM on the full
+    resolution, all finer levels are skipped then.
+
+    Parameters
+    ----------
+    img_l : cv.Mat
+        Rectified left image
+    img_r : cv.Mat
+        Rectified right image
+    sgbm_params : SGBMParams
+        Semi global matching params (of the full resolution level)
+    levels : int
+        Number of pyramid levels
+    workers : int
+        Number of worker threads (Default: 1)
+
+    Returns
+    -------
+    result : Tuple[np.ndarray, List[float]]
+        Disparity in pixels (invalid pixels are NaN) and the time spent per level in seconds, coarsest level first.
+        Skipped levels take no time
+    '''
+    pyramid = [(img_l, img_r)]
+    for _ in range(levels - 1):
+        pyramid.append((cv.pyrDown(pyramid[-1][0]), cv.pyrDown(pyramid[-1][1])))
+
+    times: List[float] = []
+
+    # Full range search on the coarsest level
+    start = time.perf_counter()
+    scale = 2 ** (levels - 1)
+    coarse_params: SGBMParams = dict(
+        sgbm_params,
+        minDisparity=sgbm_params['minDisparity'] // scale,
+        numDisparities=max(int(np.ceil(sgbm_params['numDisparities'] / scale / 16.0)) * 16, 16)
+    )
+
+    l, r = pyramid[-1]
+    disp = cv.StereoSGBM_create(**coarse_params).compute(l, r)
+    disp = raw_to_pixels(disp, coarse_params['minDisparity'])
+    times.append(time.perf_counter() - start)
+
+    # Refine level by level with limited search windows per tile
+    for level in range(levels - 2, -1, -1):
+        start = time.perf_counter()
+        scale = 2 ** level
+        l, r = pyramid[level]
+
+        level_params: SGBMParams = dict(
+            sgbm_params,
+            minDisparity=sgbm_params['minDisparity'] // scale,
+            numDisparities=max(int(np.ceil(sgbm_params['numDisparities'] / scale / 16.0)) * 16, 16)
+        )
+
+        # Disparities double with the image width
+        coarse = cv.resize(disp, (l.shape[1], l.shape[0]), interpolation=cv.INTER_NEAREST) * 2.0
+
+        height, width = l.shape[:2]
+        tiles: List[Tuple[int, int, int, int]] = [
+            (y, min(y + PYRAMID_TILE_SIZE, height), x, min(x + PYRAMID_TILE_SIZE, width))
+            for y in range(0, height, PYRAMID_TILE_SIZE)
+            for x in range(0, width, PYRAMID_TILE_SIZE)
+        ]
+
+        windows = [disparity_window(coarse[y0:y1, x0:x1], level_params) for y0, y1, x0, x1 in tiles]
+
+        # Matching costs grow with the searched pixels times the window. If the windows of the tiles (including the
+        # margins of their crops) don't narrow the search compared to the full range, plain SGBM on the full
+        # resolution is cheaper. The remaining levels are skipped
+        if tiled_work(l.shape[:2], tiles, windows, level_params) >= height * width * level_params['numDisparities']:
+            disp = cv.StereoSGBM_create(**sgbm_params).compute(img_l, img_r)
+            disp = raw_to_pixels(disp, sgbm_params['minDisparity'])
+            times.extend([0.0] * level + [time.perf_counter() - start])
+            break
+
+        if workers <= 1:
+            disps = [window_disparity(l, r, tile, window, level_params) for tile, window in zip(tiles, windows)]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                disps = list(pool.map(lambda tw: window_disparity(l, r, tw[0], tw[1], level_params),
+                                      zip(tiles, windows)))
+
+        # Stitch the tiles back together
+        disp = np.empty((height, width), np.float32)
+        for (y0, y1, x0, x1), tile_disp in zip(tiles, disps):
+            disp[y0:y1, x0:x1] = tile_disp
+
+        times.append(time.perf_counter() - start)
+
+    return disp, times
+
+
+def iter_pyramid_depth_maps(
+    imgs: ImageList,
+    rm_iter: Iterable[Rectification],
+    sgbm_params: SGBMParams,
+    levels: int,
+    workers: int = 1
+) -> Iterator[Tuple[DepthMap, List[float]]]:
+    '''
+    Compute depth maps for each image combination coarse-to-fine (see pyramid_disparity) and yield them one at a time
+    together with the time spent per pyramid level.
 
-    stereo_sgbm = cv.StereoSGBM_create(**sgbm_params)
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    rm_iter : Iterable[Rectification]
+        Rectification matrices for each combination
+    sgbm_params : SGBMParams
+        Semi global matching params
+    levels : int
+        Number of pyramid levels
+    workers : int
+        Number of worker threads (Default: 1)
+
+    Returns
+    -------
+    dm_iter : Iterator[Tuple[DepthMap, List[float]]]
+        Depth map and time spent per level (coarsest first) for each combination
+    '''
+    for rm in rm_iter:
+        with profile.stage('depth_maps', rm.combi):
+            img_l, img_r = grect.rectify_images(imgs, rm)
+            disp, times = pyramid_disparity(img_l, img_r, sgbm_params, levels, workers)
 
-    for rm in rm_list:
-        disp_sgbm = stereo_sgbm.compute(imgs[rm[4][0]][0], imgs[rm[4][1]][0]).astype(np.float32)
-        disp_sgbm = cv.normalize(disp_sgbm, 0, 255, cv.NORM_MINMAX)
+            # Invalid pixels get the lowest valid disparity before normalizing
+            raw = disp.copy()
+            valid = np.isfinite(disp)
+            disp[~valid] = disp[valid].min() if valid.any() else 0
+            disp = cv.normalize(disp, None, 0, 255, cv.NORM_MINMAX)
 
-        maps_list.append((
-            disp_sgbm,
-            rm[4]
-        ))
+        yield DepthMap(disp, raw, rm.combi), times
 
-    return maps_list
 
+def combine_maps(dm_iter: Iterable[DepthMap]) -> np.ndarray:
+    '''
+    Combine depth maps by summing them up. Depth maps are consumed one at a time, so only the running sum is kept.
+    The normalized maps are summed, as the raw disparities of different combinations have different baselines.
+    '''
+    disp = None
+    n = 0
 
-def combine_maps(dm_list: DepthMapsList) -> np.ndarray:
-    ''''''
-    if len(dm_list) == 1:
-        return dm_list[0][0]
+    for dm in dm_iter:
+        disp = dm.disp if disp is None else np.add(disp, dm.disp)
+        n += 1
 
-    disp = dm_list[0][0]
-    for i in range(1, len(dm_list)):
-        disp = np.add(disp, dm_list[i][0])
+    if n == 1:
+        return disp
 
-    return cv.normalize(disp, 0, 255, cv.NORM_MINMAX)
+    return cv.normalize(disp, None, 0, 255, cv.NORM_MINMAX)
 
 
 def sgbm_params(
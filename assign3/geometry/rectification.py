@@ -1,27 +1,200 @@
+from typing import Iterable, Iterator, Tuple
+import numpy as np
 import cv2 as cv
+import hashlib
+import glob
+import os
 
-from thints.geometry import RectificationMatricesList
-from thints.features import FundamentalMatricesList
+from thints.geometry import Rectification, RectificationMatricesList
+from thints.features import FundamentalMatrix
 from thints.images import ImageList
+import utils.profile as profile
+import utils.cache as cache
 
+# Maximum total size of the remap table cache in MB. At 12 MP, the tables of one image take about 73 MB
+REMAP_CACHE_MB = 1024
 
-def rectify(imgs: ImageList, fm_list: FundamentalMatricesList, thresh: int = 0) -> RectificationMatricesList:
-    ''''''
-    matrices_list: RectificationMatricesList = []
 
-    for m in fm_list:
-        img_height_l, img_width_l = imgs[m[4][0]][0].shape
-        img_height_r, img_width_r = imgs[m[4][1]][0].shape
+def iter_rectify(
+    imgs: ImageList,
+    fm_iter: Iterable[FundamentalMatrix],
+    thresh: int = 0
+) -> Iterator[Rectification]:
+    '''
+    Compute the rectification homographies for each combination and yield them one at a time.
 
-        _, h_l, h_r = cv.stereoRectifyUncalibrated(m[2], m[3], m[0], (img_width_l, img_height_l), threshold=thresh)
-        matrices_list.append(
-            (
-                h_l,
-                h_r,
-                (img_height_l, img_width_l),
-                (img_height_r, img_width_r),
-                m[4]
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    fm_iter : Iterable[FundamentalMatrix]
+        Fundamental matrices for each combination
+    thresh : int
+        Threshold to filter out outliers (Default: 0)
+
+    Returns
+    -------
+    rm_iter : Iterator[Rectification]
+        Rectification matrices for each combination
+    '''
+    for m in fm_iter:
+        img_height_l, img_width_l = imgs[m.combi[0]][0].shape
+        img_height_r, img_width_r = imgs[m.combi[1]][0].shape
+
+        with profile.stage('rectify', m.combi):
+            _, h_l, h_r = cv.stereoRectifyUncalibrated(
+                m.corr.inliers_l,
+                m.corr.inliers_r,
+                m.f,
+                (img_width_l, img_height_l),
+                threshold=thresh
             )
-        )
 
-    return matrices_list
+        yield Rectification(h_l, h_r, (img_height_l, img_width_l), (img_height_r, img_width_r), m.combi)
+
+
+def rectify(imgs: ImageList, fm_list: Iterable[FundamentalMatrix], thresh: int = 0) -> RectificationMatricesList:
+    '''
+    Compute the rectification homographies for each combination.
+    '''
+    return list(iter_rectify(imgs, fm_list, thresh))
+
+
+def remap_tables(h: np.ndarray, size: Tuple[int, int], fixed: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Compute the remap tables which warp an image with the homography 'h'. With identity camera matrices and no
+    distortion, initUndistortRectifyMap produces the same mapping as warpPerspective.
+
+    Parameters
+    ----------
+    h : np.ndarray
+        3x3 rectification homography
+    size : Tuple[int, int]
+        Size (height, width) of the rectified image
+    fixed : bool
+        Compute fixed-point (CV_16SC2) instead of float32 maps (Default: True)
+
+    Returns
+    -------
+    maps : Tuple[np.ndarray, np.ndarray]
+        The two remap tables
+    '''
+    m1type = cv.CV_16SC2 if fixed else cv.CV_32FC1
+    eye = np.eye(3, dtype=np.float64)
+
+    return cv.initUndistortRectifyMap(eye, None, h, eye, (size[1], size[0]), m1type)
+
+
+def cached_remap_tables(
+    h: np.ndarray,
+    size: Tuple[int, int],
+    cache_path: str,
+    key: str,
+    fixed: bool = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Return the remap tables for the homography 'h'. Tables are saved as .npy files in 'cache_path' and memory-mapped
+    when they are read again. Each entry is named by 'key' (the image and its side of a pair) and a digest of the
+    homography and the size. Writing an entry replaces the entries of the same key, e.g. from earlier runs with
+    different detector or RANSAC options, and prunes the oldest entries beyond REMAP_CACHE_MB.
+
+    Parameters
+    ----------
+    h : np.ndarray
+        3x3 rectification homography
+    size : Tuple[int, int]
+        Size (height, width) of the rectified image
+    cache_path : str
+        Path to the remap table cache directory
+    key : str
+        Key of the image within its combination, see remap_key
+    fixed : bool
+        Compute fixed-point (CV_16SC2) instead of float32 maps (Default: True)
+
+    Returns
+    -------
+    maps : Tuple[np.ndarray, np.ndarray]
+        The two remap tables
+    '''
+    digest = hashlib.sha1(np.ascontiguousarray(h, np.float64).tobytes())
+    digest.update('{}x{}-{}'.format(size[0], size[1], 'fixed' if fixed else 'float').encode())
+
+    prefix = '{}-{}'.format(key, digest.hexdigest())
+    entries = [os.path.join(cache_path, '{}-map{}.npy'.format(prefix, i)) for i in [1, 2]]
+
+    try:
+        if all([os.path.exists(entry) for entry in entries]):
+            return tuple([np.load(entry, mmap_mode='r') for entry in entries])
+    except:
+        pass
+
+    maps = remap_tables(h, size, fixed)
+
+    try:
+        for entry, m in zip(entries, maps):
+            # Write to a temporary file first, so concurrent readers never see partial tables
+            tmp = '{}.{}.tmp'.format(entry, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, m)
+            os.replace(tmp, entry)
+
+        # Remove the tables of earlier rectifications of the same image and pair
+        for stale in glob.glob(os.path.join(cache_path, '{}-*.npy'.format(key))):
+            if not os.path.basename(stale).startswith(prefix + '-'):
+                os.remove(stale)
+
+        cache.prune(cache_path, REMAP_CACHE_MB * 1024 * 1024)
+    except:
+        pass
+
+    return maps
+
+
+def remap_key(imgs: ImageList, combi: Tuple[int, int], side: int) -> str:
+    '''
+    Return the remap table cache key of the image on 'side' (0 = left, 1 = right) of the combination 'combi'. The key
+    is a digest of the paths of both images.
+    '''
+    pair = '{}|{}'.format(os.path.abspath(imgs[combi[0]][1]), os.path.abspath(imgs[combi[1]][1]))
+    return '{}-{}'.format(hashlib.sha1(pair.encode()).hexdigest(), 'lr'[side])
+
+
+def rectify_images(imgs: ImageList, rm: Rectification, use_cache: bool = True) -> Tuple[cv.Mat, cv.Mat]:
+    '''
+    Warp the left and right image of a combination with their rectification homographies. Both images are warped to
+    the size of the left image, as required by the stereo matchers.
+
+    Parameters
+    ----------
+    imgs : ImageList
+        List of images (matrices)
+    rm : Rectification
+        Rectification matrices of the combination
+    use_cache : bool
+        Read and write the remap tables from / to the on-disk cache (Default: True)
+
+    Returns
+    -------
+    result : Tuple[cv.Mat, cv.Mat]
+        The rectified left and right image
+    '''
+    rectified = []
+
+    with profile.stage('rectify_images', rm.combi):
+        for side, (h, index) in enumerate(zip((rm.h_l, rm.h_r), rm.combi)):
+            cache_path = None
+            if use_cache:
+                try:
+                    cache_path = cache.cache_dir(os.path.dirname(imgs[index][1]), 'remap')
+                except OSError:
+                    pass
+
+            # Without a usable cache directory (e.g. a read-only folder), the tables are computed uncached
+            if cache_path is not None:
+                map1, map2 = cached_remap_tables(h, rm.size_l, cache_path, remap_key(imgs, rm.combi, side))
+            else:
+                map1, map2 = remap_tables(h, rm.size_l)
+
+            rectified.append(cv.remap(imgs[index][0], map1, map2, cv.INTER_LINEAR))
+
+    return rectified[0], rectified[1]
@@ -1,44 +1,520 @@
+from typing import List
 import numpy as np
+import cv2 as cv
 
 from thints.features import EssentialMatricesList, FundamentalMatricesList
+from thints.geometry import Pose, PosesList, SweepNeighbour, SweepParams
 
-# Plane sweep algo:
-# - Sweep planes parallel to the ref camera
-# - Reproject neighbors onto each plane (homography)
-# - Compare reprojections
+# Bytes per element of the float32 cost volume
+COST_BYTES = 4
 
-# In detail
-# - Get matching keypoints
-# - Compute fundamental matrix
-# - Get epilines
-# - Find homography
-#   - iterate over planes
-#   - reproject images (warp)
-#   - blur and diff
-# - We now should have a depth map
+# Bytes per megabyte, used to convert the --max-mem budget
+ONE_MB_IN_BYTES = 1024 * 1024
 
+# Cost of pixels which are warped from outside of a neighbour image
+OUTSIDE_COST = 255.0
 
-def plane_sweep():
-    ''''''
-    # Some random pseudo code
-    depths, d = 0
-    while d < depths:
-        # Iterrate over all depths
-        pass
 
-# Calculate steps based on min, max and layers
-# import numpy as np
+def sweep_params(
+    min_depth: float,
+    max_depth: float,
+    layers: int,
+    window: int,
+    max_mem: int,
+    streaming: bool = False,
+    subpixel: bool = False,
+    uniqueness: int = 0
+) -> SweepParams:
+    '''
+    Construct a new SweepParams typed dict.
+    '''
+    p: SweepParams = {
+        'min_depth': min_depth,
+        'max_depth': max_depth,
+        'layers': layers,
+        'window': window,
+        'max_mem': max_mem,
+        'streaming': streaming,
+        'subpixel': subpixel,
+        'uniqueness': uniqueness
+    }
+    return p
 
-# min_depth = 24
-# max_depth = 45
-# depth_layers = 128
 
-# r = max_depth - min_depth
-# s = r / depth_layers
+def relative_poses(
+    em_list: EssentialMatricesList,
+    fm_list: FundamentalMatricesList,
+    intrinsic_matrix: np.ndarray
+) -> PosesList:
+    '''
+    Recover the relative pose (rotation and translation) of the right camera for each combination. Out of the four
+    possible decompositions of the essential matrix, the one which places the most inlier points in front of both
+    cameras is selected. The translation is only known up to scale and has unit length.
 
-# d = np.arange(min_depth, max_depth, s)
-# print(len(d))
+    Parameters
+    ----------
+    em_list : EssentialMatricesList
+        List of essential matrices
+    fm_list : FundamentalMatricesList
+        List of fundamental matrices with the inlier points of each combination
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
 
+    Returns
+    -------
+    poses : PosesList
+        Rotation and translation of the right camera relative to the left camera for each combination
+    '''
+    poses: PosesList = []
 
-def triangulate_points(em_list: EssentialMatricesList, fm_list: FundamentalMatricesList, intrinsic_matrix: np.ndarray):
-    ''''''
+    for em, fm in zip(em_list, fm_list):
+        # findEssentialMat can return several stacked solutions, use the first one
+        _, r, t, _ = cv.recoverPose(em.e[:3], fm.corr.inliers_l, fm.corr.inliers_r, np.float64(intrinsic_matrix))
+        poses.append(Pose(r, t, em.combi))
+
+    return poses
+
+
+def depth_layers(min_depth: float, max_depth: float, layers: int) -> np.ndarray:
+    '''
+    Return 'layers' depths between 'min_depth' and 'max_depth'. The depths are spaced uniformly in inverse depth,
+    so the image displacement between neighbouring planes is roughly constant.
+    '''
+    return 1.0 / np.linspace(1.0 / min_depth, 1.0 / max_depth, layers)
+
+
+def plane_homographies(intrinsic_matrix: np.ndarray, r: np.ndarray, t: np.ndarray, depths: np.ndarray) -> np.ndarray:
+    '''
+    Compute the homographies induced by planes parallel to the reference camera for all 'depths' at once. Each
+    homography maps pixels of the reference image to pixels of the neighbour image:
+
+        H(d) = K (R + t n^T / d) K^-1, with n = (0, 0, 1)
+
+    Parameters
+    ----------
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+    r : np.ndarray
+        Rotation of the neighbour camera relative to the reference camera
+    t : np.ndarray
+        Translation of the neighbour camera relative to the reference camera
+    depths : np.ndarray
+        Depths of the planes
+
+    Returns
+    -------
+    homographies : np.ndarray
+        Dx3x3 array of homographies
+    '''
+    k = np.float64(intrinsic_matrix)
+    k_inv = np.linalg.inv(k)
+    n = np.array([[0.0, 0.0, 1.0]])
+
+    rotation = k @ r @ k_inv
+    translation = k @ np.float64(t).reshape(3, 1) @ n @ k_inv
+
+    return rotation[np.newaxis] + translation[np.newaxis] / depths[:, np.newaxis, np.newaxis]
+
+
+def plane_cost(ref: np.ndarray, neighbours: List[SweepNeighbour], homographies: np.ndarray, window: int) -> np.ndarray:
+    '''
+    Compute the photo-consistency cost of one depth plane. Every neighbour is warped into the reference view, the
+    absolute difference to the reference image is aggregated with a box filter of size 'window' and the costs of all
+    neighbours are averaged.
+
+    Parameters
+    ----------
+    ref : np.ndarray
+        Reference image (float32)
+    neighbours : List[SweepNeighbour]
+        Neighbour images (float32) with their relative pose
+    homographies : np.ndarray
+        Nx3x3 homographies of this plane, one per neighbour
+    window : int
+        Size of the box filter window
+
+    Returns
+    -------
+    cost : np.ndarray
+        HxW float32 cost of this plane
+    '''
+    height, width = ref.shape[:2]
+    cost = np.zeros((height, width), np.float32)
+
+    for neighbour, h in zip(neighbours, homographies):
+        # H maps reference pixels to neighbour pixels, so sample the neighbour via the inverse map
+        warped = cv.warpPerspective(
+            neighbour.img,
+            h,
+            (width, height),
+            flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP,
+            borderMode=cv.BORDER_CONSTANT,
+            borderValue=np.nan
+        )
+
+        # Replace NaNs before filtering, the running sums of the box filter would spread them across the image
+        diff = np.abs(ref - warped)
+        diff[np.isnan(diff)] = OUTSIDE_COST
+        cost += cv.boxFilter(diff, cv.CV_32F, (window, window))
+
+    return cost / max(len(neighbours), 1)
+
+
+def refine_depth(
+    depths: np.ndarray,
+    index: np.ndarray,
+    cost_prev: np.ndarray,
+    cost_best: np.ndarray,
+    cost_next: np.ndarray
+) -> np.ndarray:
+    '''
+    Refine the winner-take-all depth to sub-layer precision. A parabola is fitted through the costs of the best layer
+    and its two neighbouring layers, the minimum of the parabola gives the offset to the best layer. As the layers
+    are spaced uniformly in inverse depth, the offset is interpolated in inverse depth. Pixels at the first or last
+    layer keep their layer depth.
+
+    Parameters
+    ----------
+    depths : np.ndarray
+        Depths of all layers
+    index : np.ndarray
+        HxW index of the best layer
+    cost_prev : np.ndarray
+        HxW cost of the layer before the best layer
+    cost_best : np.ndarray
+        HxW cost of the best layer
+    cost_next : np.ndarray
+        HxW cost of the layer after the best layer
+
+    Returns
+    -------
+    depth : np.ndarray
+        HxW float32 depth map
+    '''
+    position = np.float32(index)
+
+    valid = np.isfinite(cost_prev) & np.isfinite(cost_next)
+    denom = cost_prev[valid] - 2 * cost_best[valid] + cost_next[valid]
+
+    offset = np.zeros_like(denom)
+    curved = denom > 0
+    offset[curved] = (cost_prev[valid][curved] - cost_next[valid][curved]) / (2 * denom[curved])
+    position[valid] += np.clip(offset, -0.5, 0.5)
+
+    inverse = np.interp(position, np.arange(len(depths)), 1.0 / depths)
+    return np.float32(1.0 / inverse)
+
+
+def track_second_best(
+    volume: np.ndarray,
+    start: int,
+    best_index: np.ndarray,
+    changed: np.ndarray,
+    last: np.ndarray,
+    prefix: np.ndarray,
+    below: np.ndarray,
+    above: np.ndarray
+):
+    '''
+    Update the second best cost buffers in place with the costs of the layers start..start + len(volume). The second
+    best cost ignores the layers directly next to the best layer, as their costs are always close to the best one. It
+    is the minimum of 'below' (layers up to two below the best layer) and 'above' (layers from two above the best
+    layer). Both sweep modes call this with the best layers already merged, the streaming mode with a single layer,
+    so both modes yield the same second best cost.
+
+    Parameters
+    ----------
+    volume : np.ndarray
+        DxHxW costs of the layers
+    start : int
+        Index of the first layer in 'volume'
+    best_index : np.ndarray
+        HxW index of the best layer, including the layers in 'volume'
+    changed : np.ndarray
+        HxW mask of the pixels whose best layer is in 'volume'
+    last : np.ndarray
+        HxW cost of the layer start - 1 (inf for the first layer)
+    prefix : np.ndarray
+        HxW minimum cost of the layers up to start - 2, updated to the layers up to start + len(volume) - 2
+    below : np.ndarray
+        HxW minimum cost of the layers up to two below the best layer
+    above : np.ndarray
+        HxW minimum cost of the layers from two above the best layer
+    '''
+    # The layers below the chunk are all below a new best layer. The last one is next to it if the chunk starts with it
+    below[changed] = np.where(best_index >= start + 1, np.minimum(prefix, last), prefix)[changed]
+    above[changed] = np.inf
+
+    for k, cost in enumerate(volume):
+        np.minimum(below, cost, out=below, where=changed & (start + k <= best_index - 2))
+        np.minimum(above, cost, out=above, where=start + k >= best_index + 2)
+
+    np.minimum(prefix, last, out=prefix)
+    for cost in volume[:-1]:
+        np.minimum(prefix, cost, out=prefix)
+
+
+def chunked_sweep(
+    ref: np.ndarray,
+    neighbours: List[SweepNeighbour],
+    homographies: np.ndarray,
+    depths: np.ndarray,
+    params: SweepParams
+) -> np.ndarray:
+    '''
+    Sweep all planes in chunks of depth layers. The cost volume of each chunk fits into the 'max_mem' budget, the
+    winner-take-all argmin of each chunk is merged into the best layers of the previous chunks. With a 'uniqueness'
+    ratio, pixels whose best cost isn't lower than the second best cost (see track_second_best) by this percentage are
+    marked invalid (depth 0).
+    '''
+    height, width = ref.shape[:2]
+
+    # Number of depth layers per chunk, so that the cost volume fits into the memory budget
+    chunk = max(int(params['max_mem'] * ONE_MB_IN_BYTES // (height * width * COST_BYTES)), 1)
+
+    best_cost = np.full((height, width), np.inf, np.float32)
+    best_index = np.zeros((height, width), np.int32)
+    cost_prev = np.full((height, width), np.inf, np.float32)
+    cost_next = np.full((height, width), np.inf, np.float32)
+    last = np.full((height, width), np.inf, np.float32)
+    prefix = np.full((height, width), np.inf, np.float32)
+    below = np.full((height, width), np.inf, np.float32)
+    above = np.full((height, width), np.inf, np.float32)
+
+    for start in range(0, len(depths), chunk):
+        end = min(start + chunk, len(depths))
+
+        volume = np.empty((end - start, height, width), np.float32)
+        for d in range(start, end):
+            volume[d - start] = plane_cost(ref, neighbours, homographies[d], params['window'])
+
+        # The best layer so far is the last layer of the previous chunk, its next layer is the first one of this chunk
+        after = best_index == start - 1
+        cost_next[after] = volume[0][after]
+
+        # Winner-take-all within the chunk, merged with the best layers of the previous chunks
+        chunk_index = np.argmin(volume, axis=0)
+        chunk_cost = np.take_along_axis(volume, chunk_index[np.newaxis], axis=0)[0]
+
+        better = chunk_cost < best_cost
+        best_cost[better] = chunk_cost[better]
+        best_index[better] = chunk_index[better] + start
+
+        if params['subpixel']:
+            # Costs of the neighbouring layers, which can lie in the previous or the next chunk
+            prev = np.take_along_axis(volume, np.maximum(chunk_index - 1, 0)[np.newaxis], axis=0)[0]
+            prev = np.where(chunk_index > 0, prev, last)
+            following = np.take_along_axis(volume, np.minimum(chunk_index + 1, end - start - 1)[np.newaxis], axis=0)[0]
+            following = np.where(chunk_index < end - start - 1, following, np.inf)
+
+            cost_prev[better] = prev[better]
+            cost_next[better] = following[better]
+
+        if params['uniqueness'] > 0:
+            track_second_best(volume, start, best_index, better, last, prefix, below, above)
+
+        last = volume[-1].copy()
+
+    if params['subpixel']:
+        depth = refine_depth(depths, best_index, cost_prev, best_cost, cost_next)
+    else:
+        depth = np.float32(depths[best_index])
+
+    if params['uniqueness'] > 0:
+        depth[best_cost * (100 + params['uniqueness']) >= np.minimum(below, above) * 100] = 0
+
+    return depth
+
+
+def streaming_sweep(
+    ref: np.ndarray,
+    neighbours: List[SweepNeighbour],
+    homographies: np.ndarray,
+    depths: np.ndarray,
+    params: SweepParams
+) -> np.ndarray:
+    '''
+    Sweep all planes one by one without a cost volume. Each plane updates running per-pixel buffers in place: the
+    best cost and layer, the second best cost (see track_second_best) and the costs of the layers next to the best
+    layer. Memory is O(H x W), regardless of the number of layers.
+
+    With a 'uniqueness' ratio, pixels whose best cost isn't lower than the second best cost by this percentage are
+    marked invalid (depth 0). The result is the same as the one of the chunked mode.
+    '''
+    height, width = ref.shape[:2]
+
+    best_cost = np.full((height, width), np.inf, np.float32)
+    best_index = np.zeros((height, width), np.int32)
+    cost_prev = np.full((height, width), np.inf, np.float32)
+    cost_next = np.full((height, width), np.inf, np.float32)
+    last = np.full((height, width), np.inf, np.float32)
+    prefix = np.full((height, width), np.inf, np.float32)
+    below = np.full((height, width), np.inf, np.float32)
+    above = np.full((height, width), np.inf, np.float32)
+
+    for d in range(len(depths)):
+        cost = plane_cost(ref, neighbours, homographies[d], params['window'])
+
+        # This plane is the next layer of the current best layer
+        adjacent = best_index == d - 1
+        cost_next[adjacent] = cost[adjacent]
+
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        best_index[better] = d
+        cost_prev[better] = last[better]
+        cost_next[better] = np.inf
+
+        if params['uniqueness'] > 0:
+            track_second_best(cost[np.newaxis], d, best_index, better, last, prefix, below, above)
+
+        last = cost
+
+    if params['subpixel']:
+        depth = refine_depth(depths, best_index, cost_prev, best_cost, cost_next)
+    else:
+        depth = np.float32(depths[best_index])
+
+    if params['uniqueness'] > 0:
+        depth[best_cost * (100 + params['uniqueness']) >= np.minimum(below, above) * 100] = 0
+
+    return depth
+
+
+def plane_sweep(
+    ref: cv.Mat,
+    neighbours: List[SweepNeighbour],
+    intrinsic_matrix: np.ndarray,
+    params: SweepParams
+) -> np.ndarray:
+    '''
+    Compute a depth map of the reference image via multi-view plane sweeping. For each depth plane, the plane-induced
+    homographies warp all neighbours into the reference view, where a windowed photo-consistency cost is computed.
+    The depth of each pixel is the winner-take-all argmin over all depth layers. By default the depth layers are
+    processed in chunks, so that the cost volume of one chunk fits into the 'max_mem' budget. In streaming mode, only
+    running per-pixel buffers are kept.
+
+    As the translation of each neighbour is only known up to scale, depths are given in units of the baseline.
+
+    Parameters
+    ----------
+    ref : cv.Mat
+        Reference image
+    neighbours : List[SweepNeighbour]
+        Neighbour images with their pose relative to the reference camera
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+    params : SweepParams
+        Plane sweep params
+
+    Returns
+    -------
+    depth : np.ndarray
+        HxW float32 depth map
+    '''
+    ref = np.float32(ref)
+    neighbours = [SweepNeighbour(np.float32(n.img), n.r, n.t) for n in neighbours]
+
+    depths = depth_layers(params['min_depth'], params['max_depth'], params['layers'])
+
+    # Homographies of all planes and neighbours at once: DxNx3x3
+    homographies = np.stack([plane_homographies(intrinsic_matrix, n.r, n.t, depths) for n in neighbours], axis=1)
+
+    if params['streaming']:
+        return streaming_sweep(ref, neighbours, homographies, depths, params)
+
+    return chunked_sweep(ref, neighbours, homographies, depths, params)
+
+
+def triangulate_pair(
+    r1: np.ndarray,
+    r2: np.ndarray,
+    t: np.ndarray,
+    pts_l: np.ndarray,
+    pts_r: np.ndarray,
+    intrinsic_matrix: np.ndarray
+) -> np.ndarray:
+    '''
+    Triangulate all correspondences of one combination. The decomposition of the essential matrix yields four possible
+    poses (R1, t), (R1, -t), (R2, t) and (R2, -t). Like cv.recoverPose, the pose which places the most points in front
+    of both cameras is selected (cheirality check). Points behind one of the cameras are dropped.
+
+    Parameters
+    ----------
+    r1 : np.ndarray
+        First possible rotation
+    r2 : np.ndarray
+        Second possible rotation
+    t : np.ndarray
+        Possible translation
+    pts_l : np.ndarray
+        Nx2 points in the left image
+    pts_r : np.ndarray
+        Nx2 points in the right image
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+
+    Returns
+    -------
+    points : np.ndarray
+        Mx3 points in the coordinate frame of the left camera
+    '''
+    k = np.float64(intrinsic_matrix)
+    p_l = k @ np.hstack((np.eye(3), np.zeros((3, 1))))
+
+    best_points = np.empty((0, 3))
+    best_count = -1
+
+    for r, s in ((r1, t), (r1, -t), (r2, t), (r2, -t)):
+        p_r = k @ np.hstack((r, s.reshape(3, 1)))
+        x = cv.triangulatePoints(p_l, p_r, pts_l.T, pts_r.T)
+
+        # Points at infinity have w = 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            points = (x[:3] / x[3]).T
+
+        depth_l = points[:, 2]
+        depth_r = points @ r[2] + s.ravel()[2]
+
+        front = np.isfinite(depth_l) & (depth_l > 0) & (depth_r > 0)
+        if np.count_nonzero(front) > best_count:
+            best_count = np.count_nonzero(front)
+            best_points = points[front]
+
+    return best_points
+
+
+def triangulate_points(
+    em_list: EssentialMatricesList,
+    fm_list: FundamentalMatricesList,
+    intrinsic_matrix: np.ndarray
+) -> np.ndarray:
+    '''
+    Triangulate the inlier correspondences of all combinations and merge them into one sparse point cloud. Points are
+    given in the coordinate frame of the left camera of each combination, so the merged cloud is only consistent if
+    all combinations share the left image (reference mode). As the translation is only known up to scale, every
+    combination is scaled to a unit baseline.
+
+    Parameters
+    ----------
+    em_list : EssentialMatricesList
+        List of essential matrices and decomposed matrix values
+    fm_list : FundamentalMatricesList
+        List of fundamental matrices with the inlier points of each combination
+    intrinsic_matrix : np.ndarray
+        Intrinsic camera matrix
+
+    Returns
+    -------
+    cloud : np.ndarray
+        Contiguous Nx3 float32 point cloud
+    '''
+    clouds: List[np.ndarray] = [np.empty((0, 3))]
+
+    for em, fm in zip(em_list, fm_list):
+        if fm.corr.inliers == 0:
+            continue
+
+        clouds.append(triangulate_pair(em.r1, em.r2, em.t, fm.corr.inliers_l, fm.corr.inliers_r, intrinsic_matrix))
+
+    return np.ascontiguousarray(np.concatenate(clouds), dtype=np.float32)
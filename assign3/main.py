@@ -1,15 +1,179 @@
+from typing import List
+import functools
 import click
 
+from thints.features import FeaturesParams
+import features.features as feat
+import features.detectors as detectors
+import utils.profile as profile
+import utils.output as output
+import utils.input as inp
 import cmd.features as features
+import cmd.bench as bench
 import cmd.rectify as rectify
 import cmd.matrix as matrix
 import cmd.sweep as sweep
+import cmd.cloud as cloud
 import cmd.dmap as dmap
 
 
+def feature_options(f):
+    '''
+    Add the feature extraction and matching options to a command. The options are passed to the command as a single
+    FeaturesParams typed dict 'f_params', which also includes the --scale option and the options of guided_options if
+    the command has them.
+    '''
+    @functools.wraps(f)
+    def command(
+        *args,
+        detector: str,
+        workers: int,
+        matcher: str,
+        cross_check: bool,
+        ransac: str,
+        ransac_thresh: float,
+        ransac_conf: float,
+        ransac_iters: int,
+        **kwargs
+    ):
+        guided = {name: kwargs.pop(name) for name in ('top_k', 'ranking') if name in kwargs}
+
+        f_params = feat.features_params(
+            workers,
+            matcher=matcher,
+            cross_check=cross_check,
+            detector=detector,
+            ransac=feat.ransac_params(ransac, ransac_thresh, ransac_conf, ransac_iters),
+            scale=int(kwargs.get('scale', 1)),
+            **guided
+        )
+        return f(*args, f_params=f_params, **kwargs)
+
+    options = [
+        click.option('-d', '--detector', default='sift', help='Feature detector',
+                     type=click.Choice(list(detectors.DETECTORS.keys())), show_default=True),
+        click.option('-w', '--workers', default=1, help='Number of feature extraction workers', type=int,
+                     show_default=True),
+        click.option('--matcher', default='flann', help='Matcher backend', type=click.Choice(['flann', 'bf']),
+                     show_default=True),
+        click.option('--cross-check', default=False, help='Only keep cross checked matches', type=bool,
+                     is_flag=True),
+        click.option('--ransac', default='ransac', help='Robust estimation method of the fundamental matrix',
+                     type=click.Choice(['ransac', 'magsac', 'usac-fast', 'prosac']), show_default=True),
+        click.option('--ransac-thresh', default=3.0, help='Maximum distance of inliers to the epipolar line',
+                     type=float, show_default=True),
+        click.option('--ransac-conf', default=0.99, help='Confidence of the robust estimation', type=float,
+                     show_default=True),
+        click.option('--ransac-iters', default=1000, help='Maximum number of robust estimation iterations', type=int,
+                     show_default=True),
+    ]
+
+    for option in reversed(options):
+        command = option(command)
+
+    return command
+
+
+def guided_options(f):
+    '''
+    Add the options of the guided combination mode to a command which supports all combination modes. Requires
+    feature_options, which passes them on as part of the FeaturesParams.
+    '''
+    options = [
+        click.option('--top-k', default=2, help='Number of neighbours per image in the guided combination mode',
+                     type=int, show_default=True),
+        click.option('--ranking', default='bovw', help='Ranking of the guided combination mode',
+                     type=click.Choice(['bovw', 'time']), show_default=True),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
+def parse_images(ctx, param, value):
+    '''
+    Parse the comma separated image numbers of the --images option.
+    '''
+    if value is None:
+        return []
+
+    indices, ok = inp.parse_indices(value)
+    if not ok:
+        raise click.BadParameter('Expected comma separated image numbers without duplicates, e.g. 1,3,4')
+
+    return indices
+
+
+def selection_options(f):
+    '''
+    Add the options which select images and combinations without prompting.
+    '''
+    options = [
+        click.option('--images', default=None, help='Comma separated numbers of the images to use, e.g. 1,3,4',
+                     type=str, callback=parse_images),
+        click.option('--all', 'all_images', default=False, help='Use all images (instead of --images)', type=bool,
+                     is_flag=True),
+        click.option('--mode', default=None, help='Combination mode', type=click.Choice(list(inp.COMBINATION_MODES))),
+        click.option('--ref', default=0, help='Number of the reference image among the selected images (implies '
+                     '--mode ref)', type=int),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
+def ref_mode(mode: str) -> str:
+    '''
+    Return the combination mode of commands which need a reference image. Raises a click.UsageError for any other
+    mode than 'ref'.
+    '''
+    if mode not in (None, 'ref'):
+        raise click.UsageError(f'--mode {mode} is not supported, this command needs a reference image (--mode ref)')
+
+    return 'ref'
+
+
+def output_options(f):
+    '''
+    Add the options which control how results are presented.
+    '''
+    options = [
+        click.option('--no-display', default=False, help='Write results to disk instead of showing them', type=bool,
+                     is_flag=True),
+        click.option('--out-dir', default='results', help='Directory of the written results', type=str,
+                     show_default=True),
+        click.option('--disp-format', default='png', help='File format of written disparity and depth maps',
+                     type=click.Choice(output.DISPARITY_FORMATS), show_default=True),
+        click.option('--writers', default=2, help='Number of background writer threads', type=int,
+                     show_default=True),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
 @click.group()
-def cli():
-    pass
+@click.option('--profile', 'profile_format', default=None, help='Print or export stage timings and counters',
+              type=click.Choice(profile.PROFILE_FORMATS))
+@click.option('--profile-out', default=None, help='Path of the exported profile (json and trace only)', type=str)
+@click.pass_context
+def cli(ctx: click.Context, profile_format: str, profile_out: str):
+    if profile_format is None:
+        return
+
+    profile.enable()
+
+    def report():
+        if not profile.report(profile_format, profile_out):
+            click.echo('Failed to write profile')
+
+    ctx.call_on_close(report)
 
 
 @cli.group('features')
@@ -28,6 +192,14 @@ def map_group():
     pass
 
 
+@cli.group('bench')
+def bench_group():
+    '''
+    Run benchmarks.
+    '''
+    pass
+
+
 @cli.command('matrix')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 def matrix_cmd(path: str):
@@ -41,36 +213,122 @@ def matrix_cmd(path: str):
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('-t', '--thresh', default=0, help='Threshold to filter out outliers', type=int, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
-def rectify_cmd(path: str, preview: bool, thresh: int):
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
+def rectify_cmd(
+    path: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
+    thresh: int,
+    f_params: FeaturesParams
+):
     '''
     Rectify two or more images.
     '''
-    rectify.execute(path, preview, thresh)
+    rectify.execute(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
+        thresh,
+        f_params
+    )
 
 
 @features_group.command('lines')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
-def epilines_cmd(path: str, preview: bool):
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
+def epilines_cmd(
+    path: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
+    f_params: FeaturesParams
+):
     '''
     Extract epipolar lines from two or more images.
     '''
-    features.epilines(path, preview)
+    features.epilines(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
+        f_params
+    )
 
 
 @features_group.command('points')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
-def points_cmd(path: str, preview: bool):
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
+def points_cmd(
+    path: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
+    f_params: FeaturesParams
+):
     '''
     Extract matching feature points.
     '''
-    features.points(path, preview)
+    features.points(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
+        f_params
+    )
 
 
 @map_group.command('normal')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
 @click.option('--speckle-size', default=10, help='Speckle window size', type=int, show_default=True)
 @click.option('--speckle-range', default=8, help='Speckle range', type=int, show_default=True)
 @click.option('--min-disp', default=0, help='Minimum disparity', type=int, show_default=True)
@@ -78,16 +336,31 @@ def points_cmd(path: str, preview: bool):
 @click.option('--disp-diff', default=1, help='Disparity 1-2 max diff', type=int, show_default=True)
 @click.option('--unique-ratio', default=10, help='Uniqueness ratio', type=int, show_default=True)
 @click.option('--block-size', default=8, help='Block size', type=int, show_default=True)
+@click.option('--threads', default=1, help='Number of depth map threads', type=int, show_default=True)
+@click.option('--max-mem', default=0, help='Memory budget in MB for tiled matching (0 = off)', type=int,
+              show_default=True)
 def combine_map_cmd(
     path: str,
     preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
     speckle_size: int,
     speckle_range: int,
     min_disp: int,
     num_disp: int,
     disp_diff: int,
     unique_ratio: int,
-    block_size: int
+    block_size: int,
+    threads: int,
+    max_mem: int,
+    f_params: FeaturesParams
 ):
     '''
     Compute depth maps from two images or more images.
@@ -95,19 +368,31 @@ def combine_map_cmd(
     dmap.normal(
         path,
         preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
         speckle_size,
         speckle_range,
         min_disp,
         num_disp,
         disp_diff,
         unique_ratio,
-        block_size
+        block_size,
+        threads,
+        max_mem,
+        f_params
     )
 
 
 @map_group.command('combine')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
 @click.option('--speckle-size', default=10, help='Speckle window size', type=int, show_default=True)
 @click.option('--speckle-range', default=8, help='Speckle range', type=int, show_default=True)
 @click.option('--min-disp', default=0, help='Minimum disparity', type=int, show_default=True)
@@ -115,16 +400,31 @@ def combine_map_cmd(
 @click.option('--disp-diff', default=1, help='Disparity 1-2 max diff', type=int, show_default=True)
 @click.option('--unique-ratio', default=10, help='Uniqueness ratio', type=int, show_default=True)
 @click.option('--block-size', default=8, help='Block size', type=int, show_default=True)
+@click.option('--threads', default=1, help='Number of depth map threads', type=int, show_default=True)
+@click.option('--max-mem', default=0, help='Memory budget in MB for tiled matching (0 = off)', type=int,
+              show_default=True)
 def combine_map_cmd(
     path: str,
     preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
     speckle_size: int,
     speckle_range: int,
     min_disp: int,
     num_disp: int,
     disp_diff: int,
     unique_ratio: int,
-    block_size: int
+    block_size: int,
+    threads: int,
+    max_mem: int,
+    f_params: FeaturesParams
 ):
     '''
     Compute depth maps from two images or more images and combine them into a single depth map.
@@ -132,24 +432,212 @@ def combine_map_cmd(
     dmap.combine(
         path,
         preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
+        speckle_size,
+        speckle_range,
+        min_disp,
+        num_disp,
+        disp_diff,
+        unique_ratio,
+        block_size,
+        threads,
+        max_mem,
+        f_params
+    )
+
+
+@map_group.command('pyramid')
+@click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
+@click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@guided_options
+@click.option('--speckle-size', default=10, help='Speckle window size', type=int, show_default=True)
+@click.option('--speckle-range', default=8, help='Speckle range', type=int, show_default=True)
+@click.option('--min-disp', default=0, help='Minimum disparity', type=int, show_default=True)
+@click.option('--num-disp', default=64, help='Number of disparities', type=int, show_default=True)
+@click.option('--disp-diff', default=1, help='Disparity 1-2 max diff', type=int, show_default=True)
+@click.option('--unique-ratio', default=10, help='Uniqueness ratio', type=int, show_default=True)
+@click.option('--block-size', default=8, help='Block size', type=int, show_default=True)
+@click.option('--levels', default=3, help='Number of pyramid levels', type=int, show_default=True)
+@click.option('--threads', default=1, help='Number of depth map threads', type=int, show_default=True)
+def pyramid_map_cmd(
+    path: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
+    speckle_size: int,
+    speckle_range: int,
+    min_disp: int,
+    num_disp: int,
+    disp_diff: int,
+    unique_ratio: int,
+    block_size: int,
+    levels: int,
+    threads: int,
+    f_params: FeaturesParams
+):
+    '''
+    Compute depth maps from two or more images coarse-to-fine via an image pyramid.
+    '''
+    dmap.pyramid(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, mode, ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
         speckle_size,
         speckle_range,
         min_disp,
         num_disp,
         disp_diff,
         unique_ratio,
-        block_size
+        block_size,
+        levels,
+        threads,
+        f_params
     )
 
 
 @cli.command('sweep')
 @click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
 @click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
-def sweep_cmd(path: str, preview: bool):
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@output_options
+@feature_options
+@click.option('--min-depth', default=24.0, help='Depth of the nearest plane', type=float, show_default=True)
+@click.option('--max-depth', default=45.0, help='Depth of the farthest plane', type=float, show_default=True)
+@click.option('--layers', default=128, help='Number of depth layers', type=int, show_default=True)
+@click.option('--window', default=7, help='Cost aggregation window size', type=int, show_default=True)
+@click.option('--max-mem', default=512, help='Memory budget in MB for the cost volume', type=int, show_default=True)
+@click.option('--streaming', default=False, help='Keep running per-pixel buffers instead of a cost volume', type=bool,
+              is_flag=True)
+@click.option('--subpixel', default=False, help='Refine depths between layers', type=bool, is_flag=True)
+@click.option('--uniqueness', default=0, help='Uniqueness ratio in percent (0 = off)', type=int,
+              show_default=True)
+def sweep_cmd(
+    path: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    no_display: bool,
+    out_dir: str,
+    disp_format: str,
+    writers: int,
+    min_depth: float,
+    max_depth: float,
+    layers: int,
+    window: int,
+    max_mem: int,
+    streaming: bool,
+    subpixel: bool,
+    uniqueness: int,
+    f_params: FeaturesParams
+):
     '''
     Compute depth maps via plane sweeping.
     '''
-    sweep.execute(path, preview)
+    sweep.execute(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, ref_mode(mode), ref),
+        output.output_params(not no_display, out_dir, disp_format, writers),
+        min_depth,
+        max_depth,
+        layers,
+        window,
+        max_mem,
+        streaming,
+        subpixel,
+        uniqueness,
+        f_params
+    )
+
+
+@cli.command('cloud')
+@click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
+@click.option('-o', '--output', default='cloud.ply', help='Path of the PLY output file', type=str, show_default=True)
+@click.option('--preview', default=False, help='Show preview windows', type=bool, is_flag=True)
+@click.option('--scale', default='1', help='Downscale factor of the loaded images',
+              type=click.Choice(['1', '2', '4', '8']), show_default=True)
+@selection_options
+@feature_options
+def cloud_cmd(
+    path: str,
+    output: str,
+    preview: bool,
+    scale: str,
+    images: List[int],
+    all_images: bool,
+    mode: str,
+    ref: int,
+    f_params: FeaturesParams
+):
+    '''
+    Triangulate a sparse point cloud and save it as PLY.
+    '''
+    cloud.execute(
+        path,
+        preview,
+        int(scale),
+        inp.selection_params(images, all_images, ref_mode(mode), ref),
+        output,
+        f_params
+    )
+
+
+@bench_group.command('matching')
+@click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
+@click.option('-r', '--repeats', default=5, help='Number of timed repeats per backend', type=int, show_default=True)
+@click.option('-d', '--detector', default='sift', help='Feature detector',
+              type=click.Choice(list(detectors.DETECTORS.keys())), show_default=True)
+def bench_matching_cmd(path: str, repeats: int, detector: str):
+    '''
+    Benchmark the matcher backends on a fixed image set.
+    '''
+    bench.matching(path, repeats, detector)
+
+
+@bench_group.command('ransac')
+@click.option('-p', '--path', default='.data', help='Path to source images', type=str, show_default=True)
+@click.option('-r', '--repeats', default=5, help='Number of timed repeats per method', type=int, show_default=True)
+@click.option('-d', '--detector', default='sift', help='Feature detector',
+              type=click.Choice(list(detectors.DETECTORS.keys())), show_default=True)
+@click.option('--ransac-thresh', default=3.0, help='Maximum distance of inliers to the epipolar line', type=float,
+              show_default=True)
+@click.option('--ransac-conf', default=0.99, help='Confidence of the robust estimation', type=float, show_default=True)
+@click.option('--ransac-iters', default=1000, help='Maximum number of robust estimation iterations', type=int,
+              show_default=True)
+def bench_ransac_cmd(
+    path: str,
+    repeats: int,
+    detector: str,
+    ransac_thresh: float,
+    ransac_conf: float,
+    ransac_iters: int
+):
+    '''
+    Benchmark the robust estimation methods on a fixed image set.
+    '''
+    bench.ransac(path, repeats, detector, ransac_thresh, ransac_conf, ransac_iters)
 
 
 if __name__ == '__main__':
@@ -1,64 +1,221 @@
-from typing import List, Tuple, TypeAlias
+from typing import Dict, List, Tuple, TypeAlias, TypedDict
 import numpy as np
 import cv2 as cv
 
-KeypointDescriptorList: TypeAlias = List[
-    Tuple[
-        List[List[cv.KeyPoint]],
-        List[List[float]],
-        Tuple[int, int]
-    ]
-]
-
-FlannMatchesList: TypeAlias = List[
-    Tuple[
-        Tuple[Tuple[cv.DMatch, cv.DMatch]],
-        Tuple[int, int]
-    ]
-]
-
-FundamentalMatricesList: TypeAlias = List[
-    Tuple[
-        np.ndarray,
-        np.ndarray,
-        List,
-        List,
-        Tuple[int, int]
-    ]
-]
-
-FilteredMatchesList: TypeAlias = List[
-    Tuple[
-        List,
-        List,
-        List[List[int]],
-        Tuple[int, int]
-    ]
-]
-
-EpilinesList: TypeAlias = List[
-    Tuple[
-        Tuple[np.ndarray, np.ndarray],
-        Tuple[int, int]
-    ]
-]
-
-PointsList: TypeAlias = List[
-    Tuple[
-        List[cv.KeyPoint],
-        List[cv.KeyPoint],
-        Tuple[Tuple[cv.DMatch, cv.DMatch]],
-        List[List[int]],
-        Tuple[int, int]
-    ]
-]
-
-EssentialMatricesList: TypeAlias = List[
-    Tuple[
-        np.ndarray,
-        np.ndarray,
-        np.ndarray,
-        np.ndarray,
-        Tuple[int, int]
-    ]
-]
+
+class Keypoints:
+    '''
+    Keypoints and descriptors of one image. The coordinates are a Nx2 float32 array, the remaining keypoint
+    attributes (size, angle, response, octave) a Nx4 float32 array.
+    '''
+    __slots__ = ('pts', 'attributes', 'des')
+
+    def __init__(self, pts: np.ndarray, attributes: np.ndarray, des: np.ndarray) -> None:
+        self.pts = pts
+        self.attributes = attributes
+        self.des = des
+
+    def __len__(self) -> int:
+        return len(self.pts)
+
+    def to_cv(self) -> List[cv.KeyPoint]:
+        '''
+        Convert the keypoints into a list of OpenCV keypoints, e.g. for drawing.
+        '''
+        return [
+            cv.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave))
+            for (x, y), (size, angle, response, octave) in zip(self.pts, self.attributes)
+        ]
+
+
+class PairKeypoints:
+    '''
+    Keypoints and descriptors of both images of one image combination.
+    '''
+    __slots__ = ('left', 'right', 'combi')
+
+    def __init__(self, left: Keypoints, right: Keypoints, combi: Tuple[int, int]) -> None:
+        self.left = left
+        self.right = right
+        self.combi = combi
+
+
+class Matches:
+    '''
+    KNN matches of one image combination. 'idx' is a Nx2 int32 array of the left (query) and right (train) keypoint
+    index of the best match, 'distances' a Nxk float32 array of the distances of the k nearest neighbours.
+    '''
+    __slots__ = ('idx', 'distances', 'combi')
+
+    def __init__(self, idx: np.ndarray, distances: np.ndarray, combi: Tuple[int, int]) -> None:
+        self.idx = idx
+        self.distances = distances
+        self.combi = combi
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+    def to_cv(self) -> List[cv.DMatch]:
+        '''
+        Convert the best matches into a list of OpenCV matches, e.g. for drawing.
+        '''
+        return [cv.DMatch(int(q), int(t), float(d)) for (q, t), d in zip(self.idx, self.distances[:, 0])]
+
+
+KeypointDescriptorList: TypeAlias = List[PairKeypoints]
+
+KeypointDescriptorCache: TypeAlias = Dict[int, Keypoints]
+
+FlannMatchesList: TypeAlias = List[Matches]
+
+
+class Correspondences:
+    '''
+    Point correspondences of one image combination. The points are Nx2 float32 arrays, so sub-pixel precision is kept.
+    Robust estimation moves the inliers to the front, so the inlier points are views instead of copies.
+    '''
+    __slots__ = ('pts_l', 'pts_r', 'inliers', 'matches_mask', 'combi')
+
+    def __init__(
+        self,
+        pts_l: np.ndarray,
+        pts_r: np.ndarray,
+        combi: Tuple[int, int],
+        inliers: int = -1,
+        matches_mask: np.ndarray = None
+    ) -> None:
+        self.pts_l = pts_l
+        self.pts_r = pts_r
+        self.combi = combi
+        self.inliers = len(pts_l) if inliers < 0 else inliers
+        self.matches_mask = matches_mask
+
+    def __len__(self) -> int:
+        return len(self.pts_l)
+
+    @property
+    def inliers_l(self) -> np.ndarray:
+        return self.pts_l[:self.inliers]
+
+    @property
+    def inliers_r(self) -> np.ndarray:
+        return self.pts_r[:self.inliers]
+
+    @property
+    def mask(self) -> np.ndarray:
+        '''
+        Nx1 uint8 inlier mask, as returned by OpenCV.
+        '''
+        mask = np.zeros((len(self.pts_l), 1), np.uint8)
+        mask[:self.inliers] = 1
+        return mask
+
+    def partition(self, mask: np.ndarray) -> 'Correspondences':
+        '''
+        Return new correspondences with the inliers of 'mask' moved to the front. The order of the inliers is kept.
+        '''
+        keep = mask.ravel() != 0
+        order = np.concatenate((np.flatnonzero(keep), np.flatnonzero(~keep)))
+
+        return Correspondences(
+            self.pts_l[order],
+            self.pts_r[order],
+            self.combi,
+            int(np.count_nonzero(keep)),
+            self.matches_mask
+        )
+
+
+class FundamentalMatrix:
+    '''
+    Fundamental matrix of one image combination together with its correspondences.
+    '''
+    __slots__ = ('f', 'corr')
+
+    def __init__(self, f: np.ndarray, corr: Correspondences) -> None:
+        self.f = f
+        self.corr = corr
+
+    @property
+    def combi(self) -> Tuple[int, int]:
+        return self.corr.combi
+
+
+FundamentalMatricesList: TypeAlias = List[FundamentalMatrix]
+
+FilteredMatchesList: TypeAlias = List[Correspondences]
+
+
+class Epilines:
+    '''
+    Epilines (Nx3 float32) in the left and right image of one image combination.
+    '''
+    __slots__ = ('left', 'right', 'combi')
+
+    def __init__(self, left: np.ndarray, right: np.ndarray, combi: Tuple[int, int]) -> None:
+        self.left = left
+        self.right = right
+        self.combi = combi
+
+
+EpilinesList: TypeAlias = List[Epilines]
+
+
+class Points:
+    '''
+    Keypoints and matches of one image combination together with the ratio test mask of the matches.
+    '''
+    __slots__ = ('left', 'right', 'matches', 'mask', 'combi')
+
+    def __init__(
+        self,
+        left: Keypoints,
+        right: Keypoints,
+        matches: Matches,
+        mask: np.ndarray,
+        combi: Tuple[int, int]
+    ) -> None:
+        self.left = left
+        self.right = right
+        self.matches = matches
+        self.mask = mask
+        self.combi = combi
+
+
+PointsList: TypeAlias = List[Points]
+
+
+class EssentialMatrix:
+    '''
+    Essential matrix of one image combination and its decomposition into two possible rotations and a translation.
+    '''
+    __slots__ = ('e', 'r1', 'r2', 't', 'combi')
+
+    def __init__(self, e: np.ndarray, r1: np.ndarray, r2: np.ndarray, t: np.ndarray, combi: Tuple[int, int]) -> None:
+        self.e = e
+        self.r1 = r1
+        self.r2 = r2
+        self.t = t
+        self.combi = combi
+
+
+EssentialMatricesList: TypeAlias = List[EssentialMatrix]
+
+
+class RansacParams(TypedDict):
+    confidence: float
+    threshold: float
+    max_iters: int
+    method: str
+
+
+class FeaturesParams(TypedDict):
+    cross_check: bool
+    use_store: bool
+    detector: str
+    workers: int
+    matcher: str
+    top_k: int
+    ranking: str
+    ransac: RansacParams
+    scale: int
@@ -2,17 +2,71 @@ from typing import List, Tuple, TypeAlias, TypedDict
 import numpy as np
 
 
-RectificationMatricesList: TypeAlias = List[
-    Tuple[
-        np.ndarray,
-        np.ndarray,
-        Tuple[int, int],
-        Tuple[int, int],
-        Tuple[int, int]
-    ]
-]
+class Rectification:
+    '''
+    Rectification homographies of one image combination and the (height, width) of both images.
+    '''
+    __slots__ = ('h_l', 'h_r', 'size_l', 'size_r', 'combi')
 
-DepthMapsList: TypeAlias = List[Tuple[np.ndarray, Tuple[int, int]]]
+    def __init__(
+        self,
+        h_l: np.ndarray,
+        h_r: np.ndarray,
+        size_l: Tuple[int, int],
+        size_r: Tuple[int, int],
+        combi: Tuple[int, int]
+    ) -> None:
+        self.h_l = h_l
+        self.h_r = h_r
+        self.size_l = size_l
+        self.size_r = size_r
+        self.combi = combi
+
+
+RectificationMatricesList: TypeAlias = List[Rectification]
+
+
+class DepthMap:
+    '''
+    Depth (disparity) map of one image combination. 'disp' is the float32 disparity min-max stretched to 0..255 for
+    display (invalid pixels are 0), 'raw' keeps the float32 disparity in pixels (invalid pixels are NaN).
+    '''
+    __slots__ = ('disp', 'raw', 'combi')
+
+    def __init__(self, disp: np.ndarray, raw: np.ndarray, combi: Tuple[int, int]) -> None:
+        self.disp = disp
+        self.raw = raw
+        self.combi = combi
+
+
+DepthMapsList: TypeAlias = List[DepthMap]
+
+
+class Pose:
+    '''
+    Rotation and translation of the right camera relative to the left camera of one image combination.
+    '''
+    __slots__ = ('r', 't', 'combi')
+
+    def __init__(self, r: np.ndarray, t: np.ndarray, combi: Tuple[int, int]) -> None:
+        self.r = r
+        self.t = t
+        self.combi = combi
+
+
+PosesList: TypeAlias = List[Pose]
+
+
+class SweepNeighbour:
+    '''
+    Neighbour image of a plane sweep with its pose relative to the reference camera.
+    '''
+    __slots__ = ('img', 'r', 't')
+
+    def __init__(self, img: np.ndarray, r: np.ndarray, t: np.ndarray) -> None:
+        self.img = img
+        self.r = r
+        self.t = t
 
 
 class SGBMParams(TypedDict):
@@ -23,3 +77,14 @@ class SGBMParams(TypedDict):
     minDisparity: int
     speckleRange: int
     blockSize: int
+
+
+class SweepParams(TypedDict):
+    min_depth: float
+    max_depth: float
+    layers: int
+    window: int
+    max_mem: int
+    streaming: bool
+    subpixel: bool
+    uniqueness: int
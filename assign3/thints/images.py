@@ -1,6 +1,13 @@
-from typing import List, Tuple, TypeAlias
+from typing import List, Tuple, TypeAlias, TypedDict
 import cv2 as cv
 
 
 ImageList: TypeAlias = List[Tuple[cv.Mat, str]]
 CombinationsList: TypeAlias = List[List[int]]
+
+
+class SelectionParams(TypedDict):
+    images: List[int]
+    all_images: bool
+    mode: int
+    ref: int
@@ -0,0 +1,8 @@
+from typing import TypedDict
+
+
+class OutputParams(TypedDict):
+    display: bool
+    path: str
+    format: str
+    writers: int
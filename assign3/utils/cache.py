@@ -0,0 +1,99 @@
+from functools import lru_cache
+import hashlib
+import glob
+import os
+
+
+def cache_dir(base_path: str, name: str) -> str:
+    '''
+    Return (and create if needed) the cache directory 'name' located in the '.cache' folder of 'base_path'.
+
+    Parameters
+    ----------
+    base_path : str
+        Image source base path
+    name : str
+        Name of the cache sub directory
+
+    Returns
+    -------
+    path : str
+        Path to the cache directory
+    '''
+    path = os.path.join(base_path, '.cache', name)
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+
+def prune(path: str, max_bytes: int, pattern: str = '*.npy'):
+    '''
+    Remove the least recently written files matching 'pattern' in the directory 'path' until their total size is at
+    most 'max_bytes'. Files which vanish in the meantime (e.g. pruned by another process) are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache directory
+    max_bytes : int
+        Maximum total size of the matching files in bytes
+    pattern : str
+        Glob pattern of the pruned files (Default: '*.npy')
+    '''
+    files = []
+    for entry in glob.glob(os.path.join(path, pattern)):
+        try:
+            stat = os.stat(entry)
+            files.append((stat.st_mtime_ns, stat.st_size, entry))
+        except OSError:
+            pass
+
+    total = sum([size for _, size, _ in files])
+    for _, size, entry in sorted(files):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+        total -= size
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    '''
+    Return the SHA-1 hex digest of the content of the file located at 'path'.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+    chunk_size : int
+        Number of bytes read at once (Default: 1 MiB)
+
+    Returns
+    -------
+    digest : str
+        The hex digest of the file content
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _stat_file_hash(path: str, mtime: int, size: int) -> str:
+    return file_hash(path)
+
+
+def cached_file_hash(path: str) -> str:
+    '''
+    Return the SHA-1 hex digest of the file located at 'path'. The digest is computed once per process and reused as
+    long as the modification time and size of the file stay the same.
+    '''
+    stat = os.stat(path)
+    return _stat_file_hash(path, stat.st_mtime_ns, stat.st_size)
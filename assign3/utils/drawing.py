@@ -1,4 +1,4 @@
-from typing import List, Tuple
+from thints.features import Keypoints, Matches
 import numpy as np
 import cv2 as cv
 
@@ -18,19 +18,19 @@ def epilines(img, lines):
 
 def matching_keypoints(
     img_l: cv.Mat,
-    kp_l: List[cv.KeyPoint],
+    kp_l: Keypoints,
     img_r: cv.Mat,
-    kp_r: List[cv.KeyPoint],
-    matches: Tuple[Tuple[cv.DMatch, cv.DMatch]],
-    mask: List[List[int]]
+    kp_r: Keypoints,
+    matches: Matches,
+    mask: np.ndarray
 ) -> cv.Mat:
     '''
-    Draw connecting lines for matched points.
+    Draw connecting lines for matched points. The OpenCV objects are only created for drawing.
     '''
     params = dict(
         flags=cv.DrawMatchesFlags_DEFAULT,
         singlePointColor=(255, 0, 0),
         matchColor=(0, 255, 0),
-        matchesMask=mask
+        matchesMask=mask.astype(np.uint8).tolist()
     )
-    return cv.drawMatchesKnn(img_l, kp_l, img_r, kp_r, matches, None, **params)
+    return cv.drawMatches(img_l, kp_l.to_cv(), img_r, kp_r.to_cv(), matches.to_cv(), None, **params)
@@ -1,10 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
+import numpy as np
+import hashlib
 import cv2 as cv
 import click
 import glob
 import os
 
 from thints.images import ImageList, CombinationsList
+import utils.profile as profile
+import utils.cache as cache
+
+# Grayscale decoding flags for each supported downscale factor
+READ_FLAGS = {
+    1: cv.IMREAD_GRAYSCALE,
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
 
 
 class ImageError:
@@ -34,7 +47,7 @@ def list(base_path: str) -> Tuple[list, bool]:
 
     # Get all .jpg images from the data folder
     pattern = os.path.join(base_path, '*.jpg')
-    img_paths = glob.glob(pattern)
+    img_paths = sorted(glob.glob(pattern))
 
     # No images found
     if len(img_paths) == 0:
@@ -62,14 +75,101 @@ def print_list(img_paths: list):
     click.echo(sep)
 
 
-def load_images(paths: List[str]) -> Tuple[ImageList, ImageError]:
+def load_image(path: str, scale: int = 1) -> cv.Mat:
+    '''
+    Decode a single image in grayscale. The file is read into memory first and decoded via cv.imdecode, which releases
+    the GIL, so multiple images can be decoded concurrently in threads.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    scale : int
+        Downscale factor (one of READ_FLAGS), the JPEG decoder skips the unneeded resolution directly
+
+    Returns
+    -------
+    img : cv.Mat
+        The decoded image or None if the image could not be decoded
+    '''
+    buf = np.fromfile(path, np.uint8)
+    return cv.imdecode(buf, READ_FLAGS[scale])
+
+
+def cached_load_image(path: str, scale: int = 1) -> cv.Mat:
+    '''
+    Return the decoded image at 'path'. Decoded images are saved as raw .npy files in the '.cache/images' folder next
+    to the image, keyed by the path, modification time and size of the file and the scale. Subsequent loads
+    memory-map the .npy file instead of decoding the image again, so the pages are shared between processes via the
+    OS page cache. The returned array is read-only in this case. Entries of an earlier version of the file are removed
+    when a new entry is written. If the cache can't be used (e.g. a read-only folder), the image is decoded uncached.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    scale : int
+        Downscale factor (one of READ_FLAGS)
+
+    Returns
+    -------
+    img : cv.Mat
+        The decoded image or None if the image could not be decoded
     '''
-    Load n images from 'paths' via OpenCV at the same time in grayscale.
+    try:
+        stat = os.stat(path)
+        path_digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        stat_digest = hashlib.sha1('{}-{}'.format(stat.st_mtime_ns, stat.st_size).encode()).hexdigest()
+
+        cache_path = cache.cache_dir(os.path.dirname(path), 'images')
+        entry = os.path.join(cache_path, '{}-{}-s{}.npy'.format(path_digest, stat_digest, scale))
+
+        if os.path.exists(entry):
+            return np.load(entry, mmap_mode='r')
+    except:
+        return load_image(path, scale)
+
+    img = load_image(path, scale)
+    if img is None:
+        return None
+
+    try:
+        # Write to a temporary file first, so concurrent readers never see partial images
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp, entry)
+
+        # Remove the entries (of all scales) of earlier versions of the file
+        for stale in glob.glob(os.path.join(cache_path, '{}-*.npy'.format(path_digest))):
+            if not os.path.basename(stale).startswith('{}-{}-'.format(path_digest, stat_digest)):
+                os.remove(stale)
+    except:
+        pass
+
+    return img
+
+
+def load_images(
+    paths: List[str],
+    scale: int = 1,
+    threads: int = 0,
+    use_cache: bool = True
+) -> Tuple[ImageList, ImageError]:
+    '''
+    Load n images from 'paths' via OpenCV at the same time in grayscale. The images are decoded concurrently in a pool
+    of 'threads' threads.
 
     Parameters
     ----------
     paths : List[str]
         List of image paths
+    scale : int
+        Downscale factor of the loaded images (1, 2, 4 or 8)
+    threads : int
+        Number of decoding threads (0 = one per CPU core)
+    use_cache : bool
+        Use the decoded image cache (see cached_load_image)
 
     Returns
     -------
@@ -78,16 +178,32 @@ def load_images(paths: List[str]) -> Tuple[ImageList, ImageError]:
     '''
     images: ImageList = []
 
+    if scale not in READ_FLAGS:
+        return images, ImageError(f'Unsupported scale {scale}, use one of {", ".join(map(str, READ_FLAGS))}')
+
     for path in paths:
         if not os.path.exists(path):
             return images, ImageError(f'Image at {path} does not exist')
 
-        try:
-            img = cv.imread(path, cv.IMREAD_GRAYSCALE)
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+
+    with profile.stage('load_images'), ThreadPoolExecutor(max_workers=max(min(threads, len(paths)), 1)) as pool:
+        loader = cached_load_image if use_cache else load_image
+        futures = [pool.submit(loader, path, scale) for path in paths]
+
+        for path, future in zip(paths, futures):
+            try:
+                img = future.result()
+            except:
+                img = None
+
+            if img is None:
+                return images, ImageError(f'Failed to read image at {path}')
+
             images.append((img, path))
-        except:
-            return images, ImageError(f'Failed to read image at {path}')
 
+    profile.count('images', len(images))
     return images, None
 
 
@@ -2,9 +2,71 @@ from typing import List, Tuple
 import cv2 as cv
 import click
 
-from thints.images import ImageList
+from thints.images import ImageList, SelectionParams
 import utils.images as images
 
+# Combination modes which can be selected without a prompt
+COMBINATION_MODES = {
+    'all': 1,
+    'ref': 2,
+    'guided': 3,
+}
+
+
+def selection_params(
+    images: List[int] = None,
+    all_images: bool = False,
+    mode: str = None,
+    ref: int = 0
+) -> SelectionParams:
+    '''
+    Construct a new SelectionParams typed dict. Every value which is not set is prompted for by handle_images. Passing
+    a reference image implies the 'ref' combination mode. Raises a click.UsageError for conflicting options.
+    '''
+    if images and all_images:
+        raise click.UsageError('--images and --all are mutually exclusive')
+
+    if ref > 0 and mode not in (None, 'ref'):
+        raise click.UsageError(f'--ref requires --mode ref, got --mode {mode}')
+
+    if mode is None and ref > 0:
+        mode = 'ref'
+
+    p: SelectionParams = {
+        'images': images or [],
+        'all_images': all_images,
+        'mode': COMBINATION_MODES.get(mode, 0),
+        'ref': ref
+    }
+    return p
+
+
+def parse_indices(value: str) -> Tuple[List[int], bool]:
+    '''
+    Parse a comma separated list of image numbers, e.g. '1,3,4'.
+
+    Parameters
+    ----------
+    value : str
+        Comma separated list of image numbers
+
+    Returns
+    -------
+    indices : List[int]
+        List of image numbers
+    ok : bool
+        False if the value is malformed or contains duplicates
+    '''
+    try:
+        indices = [int(v) for v in value.split(',') if v.strip() != '']
+    except:
+        return [], False
+
+    if len(set(indices)) != len(indices):
+        return [], False
+
+    return indices, True
+
 
 def range_input(message: str, min: int, max: int, verbose: bool = True) -> Tuple[int, bool]:
     '''
@@ -132,30 +194,77 @@ def enforce_input_from_values(message: str, values: List[int]) -> int:
     return index
 
 
-def handle_images(base_path: str, preview: bool) -> Tuple[ImageList, int, int]:
-    ''''''
+def handle_images(
+    base_path: str,
+    preview: bool,
+    scale: int = 1,
+    selection: SelectionParams = None
+) -> Tuple[ImageList, int, int]:
+    '''
+    Select and load images. Values which are set in 'selection' are used as is, the user is prompted for all other
+    values.
+
+    Parameters
+    ----------
+    base_path : str
+        Image source base path
+    preview : bool
+        Show a preview of all loaded images
+    scale : int
+        Downscale factor of the loaded images
+    selection : SelectionParams
+        Image selection params (Default: prompt for everything)
+
+    Returns
+    -------
+    result : Tuple[ImageList, int, int]
+        The loaded images (None on error), the combination mode and the zero-indexed reference image index
+    '''
+    if selection is None:
+        selection = selection_params()
+
     img_paths, ok = images.list(base_path)
     if not ok:
         click.echo('No images found')
+        return None, 0, -1
 
-    # Prompt the user to sepcify how many images to use
-    required_inputs = enforce_range_input(
-        f'Enter how many images to use (min 2, max {len(img_paths)}): ', 2, len(img_paths))
+    indices = selection['images']
+    if selection['all_images']:
+        indices = [i for i in range(1, len(img_paths) + 1)]
+
+    if len(indices) > 0:
+        if len(indices) < 2 or not all([1 <= i <= len(img_paths) for i in indices]):
+            click.echo(f'Select at least 2 images between 1 and {len(img_paths)}')
+            return None, 0, -1
+    else:
+        # Prompt the user to sepcify how many images to use
+        required_inputs = enforce_range_input(
+            f'Enter how many images to use (min 2, max {len(img_paths)}): ', 2, len(img_paths))
 
     # Prompt the user to specify which combinations to create
-    combi_mode = handle_combination_mode()
+    combi_mode = selection['mode']
+    if combi_mode == 0:
+        combi_mode = handle_combination_mode()
 
-    images.print_list(img_paths)
+    if len(indices) == 0:
+        images.print_list(img_paths)
 
-    # Prompt the user to select n images
-    indices = enforce_multi_range_input(
-        f'Enter number between 1 and {len(img_paths)} to select image to use: ', 1, len(img_paths), required_inputs)
+        # Prompt the user to select n images
+        indices = enforce_multi_range_input(
+            f'Enter number between 1 and {len(img_paths)} to select image to use: ', 1, len(img_paths),
+            required_inputs)
 
     # If the user selected the ref combination mode, aks for the index of the reference image
     ref_index = -1
     if combi_mode == 2:
-        allowed_indices = [i for i in range(1, len(indices) + 1)]
-        ref_index = enforce_input_from_values('Please enter the index of the reference image: ', allowed_indices)
+        ref_index = selection['ref']
+        if ref_index > len(indices):
+            click.echo(f'The reference image must be between 1 and {len(indices)}')
+            return None, combi_mode, -1
+
+        if ref_index <= 0:
+            allowed_indices = [i for i in range(1, len(indices) + 1)]
+            ref_index = enforce_input_from_values('Please enter the index of the reference image: ', allowed_indices)
 
     # Collect selected image paths
     selected_img_paths: List[str] = []
@@ -163,7 +272,7 @@ def handle_images(base_path: str, preview: bool) -> Tuple[ImageList, int, int]:
         selected_img_paths.append(img_paths[index - 1])
 
     # Load images with OpenCV
-    imgs, err = images.load_images(selected_img_paths)
+    imgs, err = images.load_images(selected_img_paths, scale)
     if err != None:
         click.echo(f'Failed to load images: {err.message}')
         return None, combi_mode, ref_index
@@ -185,6 +294,7 @@ def handle_combination_mode() -> int:
     click.echo('\nPlease select the combination mode')
     click.echo('------------------')
     click.echo('  [1] All combinations\n  [2] All combinations with a reference image')
+    click.echo('  [3] Combinations with the most similar images (see --top-k)')
     click.echo('------------------')
 
-    return enforce_range_input('Enter a number between 1 and 2: ', 1, 2)
+    return enforce_range_input('Enter a number between 1 and 3: ', 1, 3)
@@ -0,0 +1,202 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Deque, List, Tuple
+from collections import deque
+import numpy as np
+import cv2 as cv
+import click
+import os
+
+from thints.output import OutputParams
+
+# File formats of written disparity (and depth) maps
+DISPARITY_FORMATS = ('png', 'npy', 'exr')
+
+# Number of pending writes per writer thread before the compute loop has to wait
+PENDING_PER_WRITER = 4
+
+
+def output_params(display: bool = True, path: str = 'results', format: str = 'png', writers: int = 2) -> OutputParams:
+    '''
+    Construct a new OutputParams typed dict.
+    '''
+    p: OutputParams = {
+        'display': display,
+        'path': path,
+        'format': format,
+        'writers': writers
+    }
+    return p
+
+
+def to_uint8(img: np.ndarray) -> np.ndarray:
+    '''
+    Stretch a single channel image of any depth to the full 8-bit range. 8-bit images are returned as is.
+    '''
+    if img.dtype == np.uint8:
+        return img
+
+    return cv.normalize(img, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U)
+
+
+def display(window: str, img: np.ndarray):
+    '''
+    Show 'img' in the window 'window' and wait for a key press. Images which aren't 8-bit (e.g. float disparity maps)
+    are stretched to the full 8-bit range first, imshow would clip them otherwise.
+    '''
+    cv.namedWindow(window, cv.WINDOW_NORMAL)
+    cv.imshow(window, to_uint8(img))
+    cv.waitKey(0)
+
+
+def write_image(path: str, img: np.ndarray) -> bool:
+    '''
+    Write 'img' losslessly as 8-bit PNG to 'path'.
+
+    Parameters
+    ----------
+    path : str
+        Path of the written file
+    img : np.ndarray
+        Image (matrix)
+
+    Returns
+    -------
+    ok : bool
+        Status of this function
+    '''
+    try:
+        return cv.imwrite(path, to_uint8(img))
+    except:
+        return False
+
+
+def write_disparity(path: str, disp: np.ndarray, format: str, raw: np.ndarray = None) -> bool:
+    '''
+    Write the disparity map 'disp' to 'path' (without extension). 'png' stretches the disparities to the full range of
+    a 16-bit PNG, 'npy' and 'exr' keep the float32 values of 'raw' (or 'disp' if there is no raw map).
+
+    Parameters
+    ----------
+    path : str
+        Path of the written file without extension
+    disp : np.ndarray
+        Disparity map
+    format : str
+        One of DISPARITY_FORMATS
+    raw : np.ndarray
+        Unnormalized disparity map in pixels, used by 'npy' and 'exr' (Default: None)
+
+    Returns
+    -------
+    ok : bool
+        Status of this function
+    '''
+    values = disp if raw is None else raw
+
+    try:
+        if format == 'npy':
+            np.save(path + '.npy', np.float32(values))
+            return True
+
+        if format == 'exr':
+            # The OpenEXR codec is enabled by ResultWriter
+            return cv.imwrite(path + '.exr', np.float32(values))
+
+        return cv.imwrite(path + '.png', cv.normalize(disp, None, 0, 65535, cv.NORM_MINMAX, cv.CV_16U))
+    except:
+        return False
+
+
+class ResultWriter:
+    '''
+    Writes results into the results directory. Encoding and writing happens on a pool of background threads (OpenCV
+    releases the GIL while encoding), so I/O doesn't block the compute loop. If the writers fall behind, submitting
+    waits for the oldest pending write, which keeps the number of buffered results bounded.
+    '''
+
+    def __init__(self, params: OutputParams) -> None:
+        self.params = params
+        self.pool: ThreadPoolExecutor = None
+        self.pending: Deque[Tuple[str, Future]] = deque()
+        self.failed: List[str] = []
+
+        # OpenCV only enables the OpenEXR codec on request, the flag is read on the first use of the codec. Changing
+        # the environment while other threads call into OpenCV is unsafe, so it is set here before any write starts
+        if params['format'] == 'exr':
+            os.environ.setdefault('OPENCV_IO_ENABLE_OPENEXR', '1')
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def path(self, name: str) -> str:
+        '''
+        Return the path of the result 'name' in the results directory. The directory is created if needed, failing to
+        do so fails the write later on.
+        '''
+        try:
+            os.makedirs(self.params['path'], exist_ok=True)
+        except OSError:
+            pass
+
+        return os.path.join(self.params['path'], name)
+
+    def submit(self, path: str, fn: Callable[..., bool], *args):
+        '''
+        Run the write function 'fn' on a background thread. 'fn' returns False if writing 'path' failed.
+        '''
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=max(self.params['writers'], 1))
+
+        self.pending.append((path, self.pool.submit(fn, path, *args)))
+
+        while len(self.pending) > max(self.params['writers'], 1) * PENDING_PER_WRITER:
+            self.collect(*self.pending.popleft())
+
+    def collect(self, path: str, future: Future):
+        '''
+        Wait for the write 'future' of 'path' and record the path if it failed.
+        '''
+        try:
+            ok = future.result()
+        except:
+            ok = False
+
+        if not ok:
+            self.failed.append(path)
+
+    def image(self, name: str, img: np.ndarray):
+        '''
+        Write an 8-bit image, e.g. an overlay visualization, as 'name' (without extension).
+        '''
+        self.submit(self.path(name + '.png'), write_image, img)
+
+    def pair(self, name: str, img_l: np.ndarray, img_r: np.ndarray):
+        '''
+        Write both images of a (rectified) image pair as 'name-l' and 'name-r' (without extension).
+        '''
+        self.image(name + '-l', img_l)
+        self.image(name + '-r', img_r)
+
+    def disparity(self, name: str, disp: np.ndarray, raw: np.ndarray = None):
+        '''
+        Write a disparity (or depth) map as 'name' (without extension) in the configured format. 'raw' is the
+        unnormalized disparity written by the float formats, see write_disparity.
+        '''
+        self.submit(self.path(name), write_disparity, disp, self.params['format'], raw)
+
+    def close(self):
+        '''
+        Wait for all pending writes and report the failed ones.
+        '''
+        while self.pending:
+            self.collect(*self.pending.popleft())
+
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+        for path in self.failed:
+            click.echo(f'Failed to write {path}')
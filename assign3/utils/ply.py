@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def write(path: str, points: np.ndarray) -> bool:
+    '''
+    Write the Nx3 point cloud 'points' as a binary PLY file to 'path'. The file can be loaded by Open3D via
+    o3d.io.read_point_cloud.
+
+    Parameters
+    ----------
+    path : str
+        Path of the PLY file
+    points : np.ndarray
+        Nx3 point cloud
+
+    Returns
+    -------
+    ok : bool
+        Status of this function
+    '''
+    points = np.ascontiguousarray(points, dtype='<f4').reshape(-1, 3)
+
+    header = '\n'.join([
+        'ply',
+        'format binary_little_endian 1.0',
+        f'element vertex {len(points)}',
+        'property float x',
+        'property float y',
+        'property float z',
+        'end_header',
+        ''
+    ])
+
+    try:
+        with open(path, 'wb') as f:
+            f.write(header.encode('ascii'))
+            f.write(points.tobytes())
+    except OSError:
+        return False
+
+    return True
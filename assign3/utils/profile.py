@@ -0,0 +1,263 @@
+from typing import Any, Dict, Iterator, List, Tuple
+from contextlib import contextmanager
+import threading
+import json
+import time
+import sys
+import os
+
+import click
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Output formats of the profile report
+PROFILE_FORMATS = ('table', 'json', 'trace')
+
+# Per-pair counters in the order they are reported
+PAIR_COUNTERS = ('keypoints_l', 'keypoints_r', 'raw_matches', 'good_matches', 'inliers')
+
+_lock = threading.Lock()
+_enabled = False
+_start = 0.0
+
+# Finished stages as (name, thread id, start, end, peak RSS, combi) tuples
+_events: List[Tuple[str, int, float, float, int, Tuple[int, int]]] = []
+_counters: Dict[str, int] = {}
+_pairs: Dict[Tuple[int, int], Dict[str, int]] = {}
+
+
+def enable():
+    '''
+    Enable the instrumentation and reset all recorded stages and counters. Until this is called, stage, count and
+    pair are no-ops.
+    '''
+    global _enabled, _start
+
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _pairs.clear()
+        _start = time.perf_counter()
+        _enabled = True
+
+
+def enabled() -> bool:
+    '''
+    Return if the instrumentation is enabled.
+    '''
+    return _enabled
+
+
+def peak_rss() -> int:
+    '''
+    Return the peak resident set size of this process in bytes. The value is read via the resource module, psutil is
+    used on platforms without it. Returns 0 if neither is available.
+    '''
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Linux reports kilobytes, macOS bytes
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+
+    return 0
+
+
+@contextmanager
+def stage(name: str, combi: Tuple[int, int] = None) -> Iterator[None]:
+    '''
+    Time the enclosed block as stage 'name', optionally for the image combination 'combi'. Stages can be nested and
+    entered from multiple threads.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage
+    combi : Tuple[int, int]
+        Image combination the stage works on (Default: None)
+    '''
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        rss = peak_rss()
+
+        with _lock:
+            _events.append((name, threading.get_ident(), start, end, rss, tuple(combi) if combi else None))
+
+
+def count(name: str, value: int = 1):
+    '''
+    Add 'value' to the counter 'name'.
+    '''
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def pair(combi: Tuple[int, int], **counts: int):
+    '''
+    Record counts (e.g. keypoints, raw matches, inliers) of the image combination 'combi'. See PAIR_COUNTERS.
+    '''
+    if not _enabled:
+        return
+
+    with _lock:
+        _pairs.setdefault(tuple(combi), {}).update(counts)
+
+
+def stages() -> Dict[str, Dict[str, float]]:
+    '''
+    Return the number of calls, total, mean and maximum wall time (in seconds) of each stage in the order the stages
+    were first entered.
+    '''
+    summary: Dict[str, Dict[str, float]] = {}
+
+    for name, _, start, end, _, _ in sorted(_events, key=lambda e: e[2]):
+        s = summary.setdefault(name, {'calls': 0, 'total': 0.0, 'max': 0.0})
+        s['calls'] += 1
+        s['total'] += end - start
+        s['max'] = max(s['max'], end - start)
+
+    for s in summary.values():
+        s['mean'] = s['total'] / s['calls']
+
+    return summary
+
+
+def to_dict() -> Dict[str, Any]:
+    '''
+    Return the recorded profile as JSON serializable dict.
+    '''
+    with _lock:
+        return {
+            'wall_time': time.perf_counter() - _start,
+            'peak_rss': peak_rss(),
+            'stages': stages(),
+            'counters': dict(_counters),
+            'pairs': [dict(combi=list(c), **counts) for c, counts in sorted(_pairs.items())],
+        }
+
+
+def to_trace() -> Dict[str, Any]:
+    '''
+    Return the recorded stages in the Chrome trace event format, which can be loaded in chrome://tracing or Perfetto.
+    Each stage is a complete event, the peak RSS at the end of each stage is a counter event.
+    '''
+    pid = os.getpid()
+    events: List[Dict[str, Any]] = []
+
+    with _lock:
+        for name, tid, start, end, rss, combi in _events:
+            ts = (start - _start) * 1e6
+            events.append({
+                'name': name,
+                'cat': 'stage',
+                'ph': 'X',
+                'ts': ts,
+                'dur': (end - start) * 1e6,
+                'pid': pid,
+                'tid': tid,
+                'args': {'combi': list(combi)} if combi else {},
+            })
+            events.append({
+                'name': 'peak_rss',
+                'ph': 'C',
+                'ts': (end - _start) * 1e6,
+                'pid': pid,
+                'args': {'MB': round(rss / (1 << 20), 1)},
+            })
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def print_table():
+    '''
+    Print the recorded profile as tables of stages, counters and per-pair counts.
+    '''
+    profile = to_dict()
+    sep = '-' * 64
+
+    click.echo(f'\nProfile\n{sep}')
+    click.echo('{:<28} {:>7} {:>9} {:>9} {:>9}'.format('Stage', 'Calls', 'Total s', 'Mean ms', 'Max ms'))
+    click.echo(sep)
+
+    for name, s in profile['stages'].items():
+        click.echo('{:<28} {:>7} {:>9.3f} {:>9.1f} {:>9.1f}'.format(
+            name, s['calls'], s['total'], s['mean'] * 1000, s['max'] * 1000))
+
+    if len(profile['counters']) > 0:
+        click.echo(sep)
+        for name, value in sorted(profile['counters'].items()):
+            click.echo('{:<28} {:>7}'.format(name, value))
+
+    if len(profile['pairs']) > 0:
+        click.echo(sep)
+        click.echo('{:<10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'Pair', 'KP left', 'KP right', 'Raw', 'Good', 'Inliers'))
+        for p in profile['pairs']:
+            click.echo('{:<10} {}'.format(
+                '{}-{}'.format(p['combi'][0] + 1, p['combi'][1] + 1),
+                ' '.join(['{:>10}'.format(p.get(c, '-')) for c in PAIR_COUNTERS])
+            ))
+
+    click.echo(sep)
+    click.echo('Wall time: {:.3f}s, peak RSS: {:.1f} MB'.format(profile['wall_time'], profile['peak_rss'] / (1 << 20)))
+    click.echo(sep)
+
+
+def report(format: str, path: str = None) -> bool:
+    '''
+    Print or export the recorded profile.
+
+    Parameters
+    ----------
+    format : str
+        One of PROFILE_FORMATS. 'table' prints a table, 'json' exports the summary and 'trace' exports all stages in
+        the Chrome trace event format
+    path : str
+        Path of the exported file. Without a path, the JSON summary is printed and the trace is written to
+        'trace.json' (Default: None)
+
+    Returns
+    -------
+    ok : bool
+        Status of this function
+    '''
+    if format == 'table':
+        print_table()
+        return True
+
+    if format == 'json' and path is None:
+        click.echo(json.dumps(to_dict(), indent=2))
+        return True
+
+    data = to_dict() if format == 'json' else to_trace()
+    path = path or 'trace.json'
+
+    try:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+    except:
+        return False
+
+    click.echo(f'Profile written to {path}')
+    return True